@@ -0,0 +1,275 @@
+"""Micro-benchmark the Database hot paths on a seeded SQLite file.
+
+    python bench/db_bench.py --accounts 1000000 --purchases 500000 --users 100000
+    python bench/db_bench.py --db /tmp/big.db --reuse --compare bench/results/db_bench_<old>.json
+
+Seeds (or reuses) a database at the requested scale, times each method the handlers call,
+prints p50/p95/p99 latency and ops/s together with EXPLAIN QUERY PLAN for every
+statement the method actually ran, and writes the numbers as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bot import ACCOUNT_TYPES, WALLETS, Database, to_minor  # noqa: E402
+
+COUNTRIES = [f"country{i:02d}" for i in range(60)]
+OWNER_ID = 1
+
+
+def seed(path: str, accounts: int, purchases: int, users: int, deposits: int, rng: random.Random):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    types = sorted(ACCOUNT_TYPES)
+    with conn:
+        conn.executemany(
+            "INSERT INTO users(user_id, username, first_name) VALUES (?, ?, ?)",
+            ((uid, f"user{uid}", f"User {uid}") for uid in range(1, users + 1)),
+        )
+        opening = to_minor(1e9)
+        for wallet in WALLETS:
+            conn.executemany(
+                "INSERT INTO wallet_ledger(user_id, wallet, kind, amount, balance_after) VALUES (?, ?, 'opening', ?, ?)",
+                ((uid, wallet, opening, opening) for uid in range(1, users + 1)),
+            )
+            conn.executemany(
+                "INSERT INTO wallet_balances(user_id, wallet, balance) VALUES (?, ?, ?)",
+                ((uid, wallet, opening) for uid in range(1, users + 1)),
+            )
+    batch = 50_000
+    for start in range(0, accounts, batch):
+        with conn:
+            conn.executemany(
+                "INSERT INTO accounts(id, number, country, price, account_type, status) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (i, f"+{10_000_000_000 + i}", rng.choice(COUNTRIES), float(rng.randint(1, 50)), rng.choice(types),
+                     "sold" if i <= purchases else "available")
+                    for i in range(start + 1, min(start + batch, accounts) + 1)
+                ),
+            )
+    for start in range(0, purchases, batch):
+        with conn:
+            conn.executemany(
+                """
+                INSERT INTO purchases(user_id, account_id, number, country, price, account_type, status)
+                SELECT ?, id, number, country, price, account_type, ? FROM accounts WHERE id = ?
+                """,
+                (
+                    (rng.randint(1, users), "pending_otp" if rng.random() < 0.2 else "otp_sent", i)
+                    for i in range(start + 1, min(start + batch, purchases) + 1)
+                ),
+            )
+    with conn:
+        conn.executemany(
+            "INSERT INTO deposit_requests(user_id, details, deposit_type) VALUES (?, ?, ?)",
+            ((rng.randint(1, users), "utr", rng.choice(("deposit_1", "deposit_2"))) for _ in range(deposits)),
+        )
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def capture_plans(db: Database, call) -> list[dict]:
+    statements: list[str] = []
+    connections = [db._writer, *db._all_readers]
+    for conn in connections:
+        await conn.set_trace_callback(statements.append)
+    try:
+        await call()
+    finally:
+        for conn in connections:
+            await conn.set_trace_callback(None)
+    plans = []
+    seen = set()
+    async with db.read() as conn:
+        for sql in statements:
+            head = sql.lstrip().split(None, 1)[0].upper()
+            if head not in {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"} or sql in seen:
+                continue
+            seen.add(sql)
+            rows = await conn.execute_fetchall("EXPLAIN QUERY PLAN " + sql)
+            plans.append({"sql": " ".join(sql.split()), "plan": [row[3] for row in rows]})
+    return plans
+
+
+async def run_case(name: str, make_call, iterations: int, concurrency: int) -> dict:
+    latencies: list[float] = []
+    calls = iter(range(iterations))
+
+    async def worker():
+        for i in calls:
+            call = make_call(i)
+            started = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    return {
+        "method": name,
+        "iterations": iterations,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "ops_per_s": iterations / wall,
+    }
+
+
+async def bench(args) -> dict:
+    rng = random.Random(args.seed)
+    path = args.db or tempfile.mktemp(prefix="db_bench_", suffix=".db")
+    fresh = not (args.reuse and os.path.exists(path))
+    db = Database(path)
+    if fresh:
+        await db.init()
+        await db.close()
+        started = time.perf_counter()
+        seed(path, args.accounts, args.purchases, args.users, args.deposits, rng)
+        print(f"seeded {path} in {time.perf_counter() - started:.1f}s")
+    db = Database(path)
+    started = time.perf_counter()
+    await db.init()
+    print(f"init (migrations + stock catalog) took {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    async with db.read() as conn:
+        (max_account,) = (await conn.execute_fetchall("SELECT MAX(id) FROM accounts"))[0]
+        (max_user,) = (await conn.execute_fetchall("SELECT MAX(user_id) FROM users"))[0]
+        sold_numbers = [r[0] for r in await conn.execute_fetchall("SELECT number FROM purchases ORDER BY random() LIMIT 5000")]
+        pending_deposits = [r[0] for r in await conn.execute_fetchall("SELECT id FROM deposit_requests WHERE status = 'pending' ORDER BY id")]
+        available = [r[0] for r in await conn.execute_fetchall(
+            "SELECT id FROM accounts WHERE status = 'available' ORDER BY random() LIMIT ?", (args.iterations * 2,)
+        )]
+    types = sorted(ACCOUNT_TYPES)
+    buyers = iter(available)
+    deposits = iter(pending_deposits)
+
+    cases = {
+        "country_page": lambda i: lambda: db.country_page(rng.choice(types), rng.randrange(3)),
+        "purchase": lambda i: (lambda account_id: lambda: db.purchase(rng.randint(1, max_user), account_id))(next(buyers)),
+        # After purchase, so the holds it leaves behind cannot take numbers purchase was given.
+        "reserve_account": lambda i: lambda: db.reserve_account(rng.randint(1, max_user), rng.choice(types), rng.choice(COUNTRIES), 600),
+        "release_expired_holds": lambda i: lambda: db.release_expired_holds(),
+        "set_price": lambda i: lambda: db.set_price(rng.choice(types), rng.choice(COUNTRIES), float(rng.randint(1, 50))),
+        "profile": lambda i: lambda: db.profile(rng.randint(1, max_user)),
+        "set_otps": lambda i: lambda: db.set_otps({number: "12345" for number in rng.sample(sold_numbers, min(args.otp_batch, len(sold_numbers)))}),
+        "apply_deposit_credit": lambda i: (lambda dep_id: lambda: db.apply_deposit_credit(dep_id, OWNER_ID, 10.0))(next(deposits)),
+        "sales_stats": lambda i: lambda: db.sales_stats(30),
+    }
+    if not sold_numbers:
+        cases.pop("set_otps")
+    if len(pending_deposits) < args.iterations + 1:
+        cases.pop("apply_deposit_credit")
+    if len(available) < args.iterations + 1:
+        cases.pop("purchase")
+    if args.only:
+        cases = {k: v for k, v in cases.items() if k in args.only}
+
+    results = []
+    for name, make_call in cases.items():
+        plans = await capture_plans(db, make_call(-1))
+        result = await run_case(name, make_call, args.iterations, args.concurrency)
+        result["plans"] = plans
+        results.append(result)
+        print(
+            f"{name:<28} p50 {result['p50_ms']:8.3f}ms  p95 {result['p95_ms']:8.3f}ms  "
+            f"p99 {result['p99_ms']:8.3f}ms  {result['ops_per_s']:10.0f} ops/s"
+        )
+        for plan in plans:
+            print(f"    {plan['sql'][:110]}")
+            for step in plan["plan"]:
+                print(f"      -> {step}")
+        if not plans:
+            print("    (no SQL: served from memory)")
+    await db.close()
+    if not args.db:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "sqlite_version": sqlite3.sqlite_version,
+        "scale": {
+            "accounts": max_account,
+            "users": max_user,
+            "purchases": args.purchases if fresh else None,
+            "deposits": len(pending_deposits),
+        },
+        "iterations": args.iterations,
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+
+
+def compare(report: dict, baseline_path: str):
+    with open(baseline_path) as fh:
+        baseline = {r["method"]: r for r in json.load(fh)["results"]}
+    print(f"\ncompared with {baseline_path}:")
+    for result in report["results"]:
+        old = baseline.get(result["method"])
+        if not old:
+            continue
+        print(
+            f"{result['method']:<28} p50 x{result['p50_ms'] / old['p50_ms']:.2f}  "
+            f"p99 x{result['p99_ms'] / old['p99_ms']:.2f}  ops/s x{result['ops_per_s'] / old['ops_per_s']:.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="database file (default: a temp file removed afterwards)")
+    parser.add_argument("--reuse", action="store_true", help="benchmark an existing --db without reseeding")
+    parser.add_argument("--accounts", type=int, default=100_000)
+    parser.add_argument("--purchases", type=int, default=50_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--deposits", type=int, default=5_000)
+    parser.add_argument("--iterations", type=int, default=1_000)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--otp-batch", type=int, default=20, help="numbers per set_otps call, like one multi-line /setotp")
+    parser.add_argument("--only", nargs="*", help="benchmark only these methods")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="JSON results path (default: bench/results/db_bench_<utc time>.json)")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    args = parser.parse_args()
+    if args.purchases > args.accounts:
+        parser.error("--purchases cannot exceed --accounts")
+
+    report = asyncio.run(bench(args))
+    out = args.out or os.path.join(
+        ROOT, "bench", "results", f"db_bench_{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.json"
+    )
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"\nresults written to {out}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Fire concurrent purchases at a seeded database and check the invariants.
+
+    python bench/purchase_stress.py --attempts 1000 --instances 2
+
+Each ``--instances`` opens its own Database (own writer + readers) on the same
+file, the way separate bot processes would. Exits non-zero if any account was
+sold twice, any wallet went negative, money was created or lost, or a cached
+balance drifted from the wallet ledger.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import ACCOUNT_TYPES, PURCHASE_OK, WALLETS, Database, from_minor  # noqa: E402
+
+
+async def seed(db: Database, accounts: int, users: int, balance: float, rng: random.Random):
+    types = sorted(ACCOUNT_TYPES)
+    async with db.write() as conn:
+        await conn.executemany(
+            "INSERT INTO accounts(number, country, price, account_type) VALUES (?, ?, ?, ?)",
+            [
+                (f"+1000{i:07d}", rng.choice(("india", "usa", "brazil")), float(rng.randint(1, 20)), rng.choice(types))
+                for i in range(accounts)
+            ],
+        )
+    for uid in range(1, users + 1):
+        for wallet in WALLETS:
+            await db.credit_wallet(uid, wallet, balance)
+
+
+async def totals(db: Database) -> tuple[float, float, int, int, int]:
+    async with db.read() as conn:
+        cur = await conn.execute("SELECT COALESCE(SUM(balance), 0), MIN(balance) FROM wallet_balances")
+        wallet_total, min_balance = await cur.fetchone()
+        cur = await conn.execute("SELECT COUNT(*), COUNT(DISTINCT account_id) FROM purchases")
+        purchases, distinct_accounts = await cur.fetchone()
+        cur = await conn.execute("SELECT COUNT(*) FROM accounts WHERE status = 'sold'")
+        (sold,) = await cur.fetchone()
+        cur = await conn.execute("SELECT COALESCE(SUM(price), 0) FROM purchases")
+        (spent,) = await cur.fetchone()
+    return from_minor(wallet_total) + spent, from_minor(min_balance), purchases, distinct_accounts, sold
+
+
+async def run(args) -> int:
+    rng = random.Random(args.seed)
+    path = args.db or tempfile.mktemp(prefix="purchase_stress_", suffix=".db")
+    instances = [Database(path) for _ in range(args.instances)]
+    for db in instances:
+        await db.init()
+    await seed(instances[0], args.accounts, args.users, args.balance, rng)
+    money_before, *_ = await totals(instances[0])
+
+    # Concentrate buyers on a few hot accounts so double-sale races actually happen.
+    hot = list(range(1, min(args.accounts, args.hot) + 1))
+    jobs = [
+        (rng.choice(instances), rng.randint(1, args.users), rng.choice(hot) if rng.random() < 0.7 else rng.randint(1, args.accounts))
+        for _ in range(args.attempts)
+    ]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(db.purchase(uid, account_id) for db, uid, account_id in jobs))
+    elapsed = time.perf_counter() - started
+
+    money_after, min_balance, purchases, distinct_accounts, sold = await totals(instances[0])
+    _, mismatches = await instances[0].reconcile_wallets()
+    ok = sum(1 for r in results if r.status == PURCHASE_OK)
+    by_status: dict[str, int] = {}
+    for r in results:
+        by_status[r.status] = by_status.get(r.status, 0) + 1
+    for db in instances:
+        await db.close()
+
+    print(f"db={path}")
+    print(f"attempts={args.attempts} in {elapsed:.2f}s ({args.attempts / elapsed:.0f}/s) results={by_status}")
+    print(f"purchases={purchases} distinct_accounts={distinct_accounts} sold={sold} min_balance={min_balance:.2f}")
+
+    failures = []
+    if purchases != distinct_accounts:
+        failures.append("an account was sold more than once")
+    if purchases != ok or sold != ok:
+        failures.append(f"{ok} successful results but {purchases} purchases / {sold} sold accounts")
+    if min_balance < 0:
+        failures.append("a wallet went negative")
+    if mismatches:
+        failures.append(f"{len(mismatches)} cached balances disagree with the ledger")
+    if abs(money_before - money_after) > 1e-6:
+        failures.append(f"money not conserved: {money_before:.2f} -> {money_after:.2f}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("OK")
+    if not args.db:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="database file to use (default: a fresh temp file)")
+    parser.add_argument("--accounts", type=int, default=300)
+    parser.add_argument("--hot", type=int, default=20, help="number of accounts most buyers fight over")
+    parser.add_argument("--users", type=int, default=60)
+    parser.add_argument("--balance", type=float, default=25.0, help="starting balance in each wallet")
+    parser.add_argument("--attempts", type=int, default=800)
+    parser.add_argument("--instances", type=int, default=2, help="Database instances sharing the file")
+    parser.add_argument("--seed", type=int, default=1)
+    raise SystemExit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""Measure update throughput of BOT_MODE=cluster as the worker count grows.
+
+    python bench/worker_scaling.py --max-workers 4 --users 400 --rounds 3 --api-latency 0.05
+
+For every worker count from 1 to ``--max-workers`` this seeds a fresh database,
+starts that many real worker processes against an in-process fake Bot API,
+routes the same synthetic update stream through UpdateRouter and reports
+updates/s once every worker has finished. Each user sends /start, opens the
+TG ACCOUNT 1 menu, reserves a number, opens the profile and buys, so the run
+mixes reads, held-account writes and wallet writes across processes.
+
+Every step writes to the one SQLite file, so this is bounded by the single writer:
+more workers add lock contention rather than throughput, and a speedup below 1x is
+the expected result. Cluster mode exists to isolate slow handlers and broadcasts.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Workers inherit this environment; set it before bot reads its configuration.
+os.environ.update(
+    {
+        "BOT_TOKEN": "123456:bench",
+        "THROTTLE_LIMITS": "",
+        "METRICS_PORT": "0",
+        "WELCOME_VIDEO_URL": "",
+        "FORCE_JOIN_CHAT_ID": "",
+        "WORKER_HOST": "127.0.0.1",
+        "WORKER_PORT": str(free_port()),
+        "TELEGRAM_SEND_RATE": "1000000",
+    }
+)
+
+from aiohttp import ClientSession, web  # noqa: E402
+
+from bot import BTN_PROFILE, BTN_TG1, WALLETS, Database, UpdateRouter, WEBHOOK_SECRET, WORKER_HOST, WORKER_PORT, spawn_workers, wait_for_workers  # noqa: E402
+
+COUNTRIES = ("india", "usa", "brazil", "nigeria")
+
+
+class FakeBotApi:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self._message_id = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        method = request.match_info["method"]
+        data = await request.json() if request.content_type == "application/json" else dict(await request.post())
+        if method in ("sendMessage", "editMessageText", "sendPhoto", "sendVideo"):
+            self._message_id += 1
+            chat_id = int(data.get("chat_id", 1))
+            return web.json_response(
+                {"ok": True, "result": {"message_id": self._message_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": ""}}
+            )
+        return web.json_response({"ok": True, "result": True})
+
+    async def start(self) -> tuple[web.AppRunner, str]:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        port = free_port()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner, f"http://127.0.0.1:{port}"
+
+
+async def seed(path: str, users: int, accounts: int, rng: random.Random) -> dict[str, int]:
+    db = Database(path)
+    await db.init()
+    async with db.write() as conn:
+        await conn.executemany(
+            "INSERT INTO accounts(number, country, price, account_type) VALUES (?, ?, ?, 'tg1')",
+            [(f"+2000{i:07d}", rng.choice(COUNTRIES), float(rng.randint(1, 20))) for i in range(accounts)],
+        )
+    for uid in range(1, users + 1):
+        for wallet in WALLETS:
+            await db.credit_wallet(uid, wallet, 1000.0)
+    country_ids = await db.country_ids(list(COUNTRIES))
+    await db.close()
+    return country_ids
+
+
+def make_updates(users: int, rounds: int, accounts: int, country_ids: dict[str, int], rng: random.Random) -> list[dict]:
+    updates = []
+    update_id = 0
+
+    def message(uid: int, text: str) -> dict:
+        return {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"User {uid}"},
+            "text": text,
+            **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]} if text.startswith("/") else {}),
+        }
+
+    def callback(uid: int, data: str) -> dict:
+        return {
+            "id": str(update_id),
+            "from": {"id": uid, "is_bot": False, "first_name": f"User {uid}"},
+            "chat_instance": "bench",
+            "message": {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}, "text": "menu"},
+            "data": data,
+        }
+
+    # Buy from the top of the id range so purchases rarely collide with the reservations.
+    buyable = list(range(1, accounts + 1))
+    for _ in range(rounds):
+        purchase = {uid: buyable.pop() if buyable else 1 for uid in range(1, users + 1)}
+        steps = [
+            ("message", lambda uid: message(uid, "/start")),
+            ("message", lambda uid: message(uid, BTN_TG1)),
+            ("callback_query", lambda uid: callback(uid, f"cty:tg1:{country_ids[rng.choice(COUNTRIES)]}")),
+            ("message", lambda uid: message(uid, BTN_PROFILE)),
+            ("callback_query", lambda uid: callback(uid, f"buy:{purchase[uid]}")),
+        ]
+        # Step by step across all users, so every user's updates interleave with everyone else's.
+        for kind, make in steps:
+            for uid in range(1, users + 1):
+                update_id += 1
+                updates.append({"update_id": update_id, kind: make(uid)})
+    return updates
+
+
+async def processed(session: ClientSession, urls: list[str]) -> int:
+    total = 0
+    for url in urls:
+        async with session.get(url + "/healthz") as resp:
+            total += (await resp.json())["processed"]
+    return total
+
+
+async def run_once(workers: int, args, api_base: str, api: FakeBotApi) -> dict:
+    rng = random.Random(args.seed)
+    path = tempfile.mktemp(prefix="worker_scaling_", suffix=".db")
+    country_ids = await seed(path, args.users, args.accounts, rng)
+    updates = make_updates(args.users, args.rounds, args.accounts, country_ids, rng)
+    os.environ["DB_PATH"] = path
+    os.environ["TELEGRAM_API_BASE"] = api_base
+    urls = [f"http://{WORKER_HOST}:{WORKER_PORT + index}" for index in range(workers)]
+    processes = await spawn_workers(workers)
+    router = UpdateRouter(urls, WEBHOOK_SECRET)
+    calls_before = api.calls
+    try:
+        async with ClientSession() as session:
+            await wait_for_workers(session, urls)
+            router.start()
+            started = time.perf_counter()
+            for raw in updates:
+                router.route(raw)
+            done, last_progress = 0, time.monotonic()
+            while done < len(updates):
+                await asyncio.sleep(0.05)
+                count = await processed(session, urls)
+                if count > done:
+                    done, last_progress = count, time.monotonic()
+                elif time.monotonic() - last_progress > args.stall_timeout:
+                    raise RuntimeError(f"workers stalled at {done}/{len(updates)} updates")
+            elapsed = time.perf_counter() - started
+        with sqlite3.connect(path) as conn:
+            (purchases,) = conn.execute("SELECT COUNT(*) FROM purchases").fetchone()
+    finally:
+        await router.stop()
+        for process in processes:
+            process.terminate()
+        await asyncio.gather(*(process.wait() for process in processes))
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    return {
+        "workers": workers,
+        "updates": len(updates),
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(len(updates) / elapsed, 1),
+        "purchases": purchases,
+        "api_calls": api.calls - calls_before,
+        "routed": router.routed,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--accounts", type=int, default=5000)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds each fake Bot API call takes")
+    parser.add_argument("--stall-timeout", type=float, default=60.0, help="give up when no update finishes for this long")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.api_latency)
+    api_runner, api_base = await api.start()
+    results = []
+    try:
+        print(f"{'workers':>7} {'updates':>8} {'seconds':>8} {'upd/s':>9} {'speedup':>8} {'bought':>7}")
+        for workers in range(1, args.max_workers + 1):
+            result = await run_once(workers, args, api_base, api)
+            results.append(result)
+            speedup = result["updates_per_second"] / results[0]["updates_per_second"]
+            print(
+                f"{workers:>7} {result['updates']:>8} {result['seconds']:>8.2f} "
+                f"{result['updates_per_second']:>9.1f} {speedup:>7.2f}x {result['purchases']:>7}",
+                flush=True,
+            )
+    finally:
+        await api_runner.cleanup()
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"args": vars(args), "results": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
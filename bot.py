@@ -1,28 +1,123 @@
 import asyncio
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import html
+import inspect
+import json
 import os
-from dataclasses import dataclass
-from typing import Optional
+import random
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
 
 import aiosqlite
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.flags import get_flag
 from aiogram.enums import ParseMode
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+)
 from aiogram.filters import Command, CommandStart
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.types import (
     CallbackQuery,
+    ChatMemberUpdated,
     FSInputFile,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
     Message,
     ReplyKeyboardMarkup,
+    Update,
 )
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
 from dotenv import load_dotenv
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8633946071:AAFEV411HFXAjsijKkzZfE1Zj_jAvMPtrLY")
 DB_PATH = os.getenv("DB_PATH", "bot.db")
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").strip()
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook").strip()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+# Every instance behind the load balancer must share it, so derive it from the token by default.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_DELETE_ON_SHUTDOWN = os.getenv("WEBHOOK_DELETE_ON_SHUTDOWN", "1") == "1"
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").strip().rstrip("/")
+# BOT_MODE=cluster: a front process fans updates out to worker processes (BOT_MODE=worker).
+WORKERS = int(os.getenv("WORKERS", str(os.cpu_count() or 2)))
+WORKER_URLS = [url.strip().rstrip("/") for url in os.getenv("WORKER_URLS", "").split(",") if url.strip()]
+WORKER_HOST = os.getenv("WORKER_HOST", "127.0.0.1").strip()
+WORKER_PORT = int(os.getenv("WORKER_PORT", "8101"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+ROUTER_BATCH_SIZE = 100
+ROUTER_MAX_QUEUED = int(os.getenv("ROUTER_MAX_QUEUED", "10000"))
+STOCK_SYNC_INTERVAL = float(os.getenv("STOCK_SYNC_INTERVAL", "2"))
+STOCK_CHANGES_KEPT_SECONDS = 3600
+FORCE_JOIN_CACHE_TTL = float(os.getenv("FORCE_JOIN_CACHE_TTL", "600"))
+FORCE_JOIN_NEGATIVE_TTL = float(os.getenv("FORCE_JOIN_NEGATIVE_TTL", "30"))
+FORCE_JOIN_CACHE_SIZE = int(os.getenv("FORCE_JOIN_CACHE_SIZE", "50000"))
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", "21600"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "100000"))
+# 0 trusts cached FSM records until evicted: polling and cluster mode pin a user to one process.
+# Several webhook instances set a few seconds, so states set by another instance show up.
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "0"))
+FSM_SWEEP_INTERVAL = 600.0
+PENDING_OTP_TTL = float(os.getenv("PENDING_OTP_TTL", "86400"))
+DEPOSIT_REMINDER_AFTER = float(os.getenv("DEPOSIT_REMINDER_AFTER", "1800"))
+DEPOSIT_REMINDER_INTERVAL = 1800.0
+DB_OPTIMIZE_INTERVAL = 6 * 3600.0
+DB_CHECKPOINT_INTERVAL = 600.0
+# The WAL file is cut back to this size whenever the writer restarts it after a full checkpoint.
+DB_WAL_SIZE_LIMIT = 64 * 1024 * 1024
+ACCOUNT_HOLD_SECONDS = int(os.getenv("ACCOUNT_HOLD_SECONDS", "300"))
+ACCOUNT_HOLD_SWEEP_INTERVAL = 15.0
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "200000"))
+USER_FLUSH_INTERVAL = 5.0
+WALLET_SNAPSHOT_INTERVAL = float(os.getenv("WALLET_SNAPSHOT_INTERVAL", "86400"))
+WALLET_SNAPSHOTS_KEPT = 7
+# group=rate/burst: sustained actions per second and how many may arrive back to back.
+THROTTLE_LIMITS = os.getenv("THROTTLE_LIMITS", "start=0.2/3,browse=2/8,reserve=0.5/4,buy=0.5/3,default=1/10")
+THROTTLE_CACHE_SIZE = int(os.getenv("THROTTLE_CACHE_SIZE", "100000"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip()
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+TELEGRAM_SEND_RATE = float(os.getenv("TELEGRAM_SEND_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "8"))
+BROADCAST_PAGE_SIZE = 100
+BROADCAST_PROGRESS_INTERVAL = 5.0
+# A running broadcast belongs to whichever instance holds its lease; each saved page renews it.
+BROADCAST_LEASE_SECONDS = 120.0
+BROADCAST_CLAIM_INTERVAL = 30.0
+# Names this process in shared rows such as broadcast leases.
+INSTANCE_ID = os.getenv("INSTANCE_ID", "").strip() or f"{socket.gethostname()}:{os.getpid()}"
 DEPOSIT_QR_PATH = os.getenv("DEPOSIT_QR_PATH", "https://files.catbox.moe/yud6sd.png")
 WELCOME_VIDEO_URL = os.getenv("WELCOME_VIDEO_URL", "https://files.catbox.moe/y1btis.mp4").strip()
 BRAND_NAME = os.getenv("BRAND_NAME", "GMS OP BOT").strip()
@@ -34,6 +129,22 @@ FORCE_JOIN_CHANNEL_LINK = "https://t.me/+oF0VkIRBFF01M2Q1"
 FORCE_JOIN_CHAT_ID = os.getenv("FORCE_JOIN_CHAT_ID", "").strip()
 DEPOSIT_REVIEW_OWNER_ID = 8394041476
 
+ACCOUNT_TYPES = {"tg1", "tg2", "whatsapp"}
+COUNTRY_PAGE_SIZE = 20
+DEPOSIT_PAGE_SIZE = 20
+PROFILE_PAGE_SIZE = 10
+STATS_DEFAULT_DAYS = 7
+STATS_MAX_DAYS = 366
+STATS_TOP_COUNTRIES = 10
+EXPORT_CHUNK_ROWS = 5000
+# Bot API upload limit for documents.
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+DEPOSIT_CREDITED = "credited"
+DEPOSIT_ALREADY_CREDITED = "already_credited"
+DEPOSIT_NOT_FOUND = "not_found"
+WALLETS = ("deposit_1", "deposit_2")
+# Wallet amounts are stored as integer paise; rupees only exist at the edges.
+MINOR_UNITS = 100
 OWNER_IDS = {6710777832, 8394041476, 8396616795, 8498330921, 8595642160}
 
 BTN_TG1 = "📲 TG ACCOUNT 1"
@@ -74,22 +185,176 @@ def buy_keyboard(account_id: int) -> InlineKeyboardMarkup:
     )
 
 
-def country_keyboard(account_type: str, countries: list[str]) -> InlineKeyboardMarkup:
+def country_keyboard(account_type: str, countries: list[tuple[int, str]], page: int, pages: int) -> InlineKeyboardMarkup:
+    # Callback data carries registry ids, not names: Telegram caps it at 64 bytes.
     rows = []
     for i in range(0, len(countries), 2):
         chunk = countries[i : i + 2]
         rows.append(
             [
                 InlineKeyboardButton(
-                    text=c,
-                    callback_data=f"country:{account_type}:{c}",
+                    text=name,
+                    callback_data=f"cty:{account_type}:{country_id}",
                 )
-                for c in chunk
+                for country_id, name in chunk
             ]
         )
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text="⬅️ Prev", callback_data=f"cpage:{account_type}:{page - 1}"))
+        nav.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=f"cpage:{account_type}:{page}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton(text="Next ➡️", callback_data=f"cpage:{account_type}:{page + 1}"))
+        rows.append(nav)
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(labelnames: tuple[str, ...], values: tuple[str, ...], le: Optional[str] = None) -> str:
+    pairs = [f'{k}="{_escape_label(v)}"' for k, v in zip(labelnames, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = (), fn=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.fn = fn
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> list[str]:
+        if self.fn is not None:
+            return [f"{self.name} {self.fn()}"]
+        return [f"{self.name}{_label_text(self.labelnames, k)} {v}" for k, v in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *labels: str, value: float):
+        self._values[labels] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series: dict[tuple[str, ...], list] = {}
+
+    def observe(self, *labels: str, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, labels, str(bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_label_text(self.labelnames, labels, '+Inf')} {count}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        out = []
+        for metric in self._metrics:
+            out.append(f"# HELP {metric.name} {metric.help_text}")
+            out.append(f"# TYPE {metric.name} {metric.kind}")
+            out.extend(metric.samples())
+        return "\n".join(out) + "\n"
+
+
+metrics = MetricsRegistry()
+UPDATE_SECONDS = metrics.register(Histogram("bot_update_seconds", "Time to process one update.", ("type",)))
+UPDATE_ERRORS = metrics.register(Counter("bot_update_errors_total", "Updates whose processing raised.", ("type",)))
+UPDATES_IN_FLIGHT = metrics.register(Gauge("bot_updates_in_flight", "Updates currently being processed."))
+HANDLER_SECONDS = metrics.register(Histogram("bot_handler_seconds", "Time spent inside a handler.", ("handler",)))
+HANDLER_ERRORS = metrics.register(Counter("bot_handler_errors_total", "Handler calls that raised.", ("handler",)))
+DB_SECONDS = metrics.register(Histogram("bot_db_seconds", "Time spent in a Database method.", ("method",)))
+DB_ERRORS = metrics.register(Counter("bot_db_errors_total", "Database method calls that raised.", ("method",)))
+API_SECONDS = metrics.register(Histogram("bot_api_seconds", "Bot API request latency.", ("method",)))
+API_ERRORS = metrics.register(Counter("bot_api_errors_total", "Bot API requests that failed.", ("method", "error")))
+THROTTLED = metrics.register(Counter("bot_throttled_total", "Updates dropped by the per-user rate limit.", ("group",)))
+JOB_SECONDS = metrics.register(Histogram("bot_job_seconds", "Duration of scheduled maintenance jobs.", ("job",)))
+JOB_RUNS = metrics.register(Counter("bot_job_runs_total", "Scheduled job runs by outcome.", ("job", "outcome")))
+LOOP_LAG = metrics.register(Gauge("bot_event_loop_lag_seconds", "How late the last event loop probe woke up."))
+
+
+def iter_chunks(cur: sqlite3.Cursor, size: int):
+    while rows := cur.fetchmany(size):
+        yield rows
+
+
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def csv_cell(value: Any) -> Any:
+    # Spreadsheets run text cells starting with these as formulas; a leading ' keeps names,
+    # usernames and +91... numbers as plain text. Real numbers stay numeric.
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def timed_methods(histogram: Histogram, errors: Counter):
+    # Class decorator: time every public coroutine method under its own name.
+    def wrap(name, fn):
+        @functools.wraps(fn)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                errors.inc(name)
+                raise
+            finally:
+                histogram.observe(name, value=time.perf_counter() - started)
+
+        return timed
+
+    def decorate(cls):
+        for name, fn in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.iscoroutinefunction(fn):
+                setattr(cls, name, wrap(name, fn))
+        return cls
+
+    return decorate
+
+
 @dataclass
 class Account:
     id: int
@@ -102,90 +367,756 @@ class Account:
     login_status: str = "pending"
 
 
+PURCHASE_OK = "ok"
+PURCHASE_NOT_FOUND = "not_found"
+PURCHASE_SOLD = "sold"
+PURCHASE_INSUFFICIENT = "insufficient_balance"
+PURCHASE_HELD = "held_by_other"
+
+
+@dataclass
+class PurchaseResult:
+    status: str
+    account: Optional[Account] = None
+    purchase_id: Optional[int] = None
+    wallet_used: Optional[str] = None
+    dep1: float = 0.0
+    dep2: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.status == PURCHASE_OK
+
+
+@dataclass
+class ProfilePage:
+    dep1: float
+    dep2: float
+    orders: int
+    spent: float
+    pending_otps: int
+    purchases: list[tuple]
+    has_older: bool
+    has_newer: bool
+
+
+@dataclass
+class SalesStats:
+    days: list[tuple[str, int, float, int, float]]
+    by_type: list[tuple[str, int, float]]
+    top_countries: list[tuple[str, str, int, float]]
+    stock: list[tuple[str, int, int]]
+
+
+class PurchaseAborted(Exception):
+    def __init__(self, result: PurchaseResult):
+        super().__init__(result.status)
+        self.result = result
+
+
+def to_minor(amount: float) -> int:
+    return round(amount * MINOR_UNITS)
+
+
+def from_minor(units: int) -> float:
+    return units / MINOR_UNITS
+
+
+def pick_wallet(account_type: str, price: float, dep1: float, dep2: float) -> Optional[str]:
+    if account_type == "tg2":
+        return "deposit_1" if dep1 >= price else None
+    if account_type == "tg1":
+        return "deposit_2" if dep2 >= price else None
+    if account_type == "whatsapp":
+        if dep1 >= price:
+            return "deposit_1"
+        if dep2 >= price:
+            return "deposit_2"
+    return None
+
+
+class CountryStock:
+    # Kept in allocation order, cheapest first and oldest among equal prices, like idx_accounts_price.
+    __slots__ = ("order", "accounts")
+
+    def __init__(self):
+        self.order: list[tuple[float, int]] = []
+        self.accounts: dict[int, Account] = {}
+
+    def add(self, account: Account):
+        if account.id in self.accounts:
+            return
+        bisect.insort(self.order, (account.price, account.id))
+        self.accounts[account.id] = account
+
+    def remove(self, account_id: int) -> Optional[Account]:
+        account = self.accounts.pop(account_id, None)
+        if account is None:
+            return None
+        del self.order[bisect.bisect_left(self.order, (account.price, account_id))]
+        return account
+
+    @property
+    def min_price(self) -> float:
+        return self.order[0][0]
+
+
+class StockCatalog:
+    # In-process mirror of available accounts, kept in step by Database writes.
+    def __init__(self):
+        self._types: dict[str, dict[str, CountryStock]] = {}
+        # Sorted country names per type, rebuilt only when a country gains or loses all stock.
+        self._sorted: dict[str, list[str]] = {}
+
+    def clear(self):
+        self._types.clear()
+        self._sorted.clear()
+
+    def add(self, account: Account):
+        countries = self._types.setdefault(account.account_type, {})
+        if account.country not in countries:
+            countries[account.country] = CountryStock()
+            self._sorted.pop(account.account_type, None)
+        countries[account.country].add(account)
+
+    def remove(self, account_type: str, country: str, account_id: int) -> Optional[Account]:
+        countries = self._types.get(account_type, {})
+        stock = countries.get(country)
+        if stock is None:
+            return None
+        account = stock.remove(account_id)
+        if not stock.order:
+            del countries[country]
+            self._sorted.pop(account_type, None)
+        return account
+
+    def get(self, account_type: str, country: str, account_id: int) -> Optional[Account]:
+        stock = self._types.get(account_type, {}).get(country)
+        return stock.accounts.get(account_id) if stock else None
+
+    def sorted_countries(self, account_type: str) -> list[str]:
+        names = self._sorted.get(account_type)
+        if names is None:
+            names = self._sorted[account_type] = sorted(self._types.get(account_type, {}))
+        return names
+
+    def _summaries(self, account_type: str, names: list[str]) -> list[tuple[str, int, float]]:
+        countries = self._types.get(account_type, {})
+        return [(country, len(countries[country].order), countries[country].min_price) for country in names]
+
+    def country_page(self, account_type: str, page: int, size: int) -> tuple[list[tuple[str, int, float]], int, int]:
+        names = self.sorted_countries(account_type)
+        pages = max(1, -(-len(names) // size))
+        page = min(max(page, 0), pages - 1)
+        return self._summaries(account_type, names[page * size : (page + 1) * size]), page, pages
+
+
+UserProfile = tuple[Optional[str], Optional[str]]
+
+
+class SeenUsers:
+    # LRU of user_id -> (username, first_name) as last written to the users table. Name
+    # changes of known users wait in `pending` until the next batched flush.
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.skipped = 0
+        self._known: OrderedDict[int, UserProfile] = OrderedDict()
+        self.pending: dict[int, UserProfile] = {}
+        self.flushing: dict[int, UserProfile] = {}
+
+    def get(self, user_id: int) -> Optional[UserProfile]:
+        profile = self.pending.get(user_id) or self.flushing.get(user_id)
+        if profile is None:
+            profile = self._known.get(user_id)
+        if profile is not None:
+            self.remember(user_id, profile)
+        return profile
+
+    def remember(self, user_id: int, profile: UserProfile):
+        self._known[user_id] = profile
+        self._known.move_to_end(user_id)
+        while len(self._known) > self.max_size:
+            self._known.popitem(last=False)
+
+    def forget(self, user_ids: list[int]):
+        for user_id in user_ids:
+            self._known.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._known)
+
+
+@timed_methods(DB_SECONDS, DB_ERRORS)
 class Database:
-    def __init__(self, path: str):
+    def __init__(self, path: str, readers: int = DB_READ_POOL_SIZE):
         self.path = path
+        self.reader_count = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._all_readers: list[aiosqlite.Connection] = []
+        self.stock = StockCatalog()
+        self._stock_cursor = 0
+        self.seen_users = SeenUsers(USER_CACHE_SIZE)
+        self._country_ids: dict[str, int] = {}
+        self._country_names: dict[int, str] = {}
+
+    async def _open_connection(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(
+            self.path,
+            isolation_level=None,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+        )
+        await conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        await conn.execute("PRAGMA journal_mode = WAL")
+        await conn.execute("PRAGMA synchronous = NORMAL")
+        await conn.execute("PRAGMA temp_store = MEMORY")
+        await conn.execute(f"PRAGMA journal_size_limit = {DB_WAL_SIZE_LIMIT}")
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._open_connection()
+        for _ in range(self.reader_count):
+            conn = await self._open_connection()
+            await conn.execute("PRAGMA query_only = ON")
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+
+    async def close(self):
+        if self._writer is None:
+            return
+        await self.flush_users()
+        async with self._write_lock:
+            for conn in self._all_readers:
+                await conn.close()
+            self._all_readers.clear()
+            self._readers = asyncio.Queue()
+            with suppress(aiosqlite.OperationalError):
+                async with self._transaction(self._writer) as conn:
+                    await conn.execute("PRAGMA optimize")
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[aiosqlite.Connection]:
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[aiosqlite.Connection]:
+        # One writer connection shared by every coroutine: the lock keeps each
+        # caller's statements inside its own transaction.
+        async with self._write_lock, self._transaction(self._writer) as conn:
+            yield conn
+
+    @asynccontextmanager
+    async def _transaction(self, conn: aiosqlite.Connection) -> AsyncIterator[aiosqlite.Connection]:
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+            yield conn
+        except BaseException:
+            # A cancelled BEGIN still runs on aiosqlite's thread. The rollback is queued behind
+            # it, so the shared writer is never handed to the next caller mid-transaction.
+            await conn.rollback()
+            raise
+        else:
+            await conn.commit()
 
     async def init(self):
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    balance REAL DEFAULT 0,
-                    deposit_1 REAL DEFAULT 0,
-                    deposit_2 REAL DEFAULT 0,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-                """
+        await self.open()
+        await self._migrate()
+        await self._load_stock()
+        await self._load_countries()
+
+    async def _migrate(self):
+        async with self.read() as db:
+            if await self._schema_version(db) >= len(self.MIGRATIONS):
+                return
+        async with self.write() as db:
+            # Re-read under the write lock: another process may have migrated meanwhile.
+            version = await self._schema_version(db)
+            for number, migration in enumerate(self.MIGRATIONS[version:], start=version + 1):
+                await migration(self, db)
+                await db.execute(f"PRAGMA user_version = {number}")
+
+    async def _schema_version(self, db) -> int:
+        cur = await db.execute("PRAGMA user_version")
+        row = await cur.fetchone()
+        return row[0]
+
+    async def _migrate_base_schema(self, db):
+        # Databases created before versioning already have some of these tables.
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                balance REAL DEFAULT 0,
+                deposit_1 REAL DEFAULT 0,
+                deposit_2 REAL DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS accounts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    number TEXT NOT NULL,
-                    country TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    account_type TEXT NOT NULL,
-                    tg_add_id INTEGER,
-                    login_status TEXT DEFAULT 'pending',
-                    status TEXT DEFAULT 'available',
-                    added_by INTEGER,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-                """
+            """
+        )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS accounts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                number TEXT NOT NULL,
+                country TEXT NOT NULL,
+                price REAL NOT NULL,
+                account_type TEXT NOT NULL,
+                tg_add_id INTEGER,
+                login_status TEXT DEFAULT 'pending',
+                status TEXT DEFAULT 'available',
+                added_by INTEGER,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS purchases (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    account_id INTEGER NOT NULL,
-                    number TEXT NOT NULL,
-                    country TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    account_type TEXT NOT NULL,
-                    otp TEXT,
-                    status TEXT DEFAULT 'pending_otp',
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-                """
+            """
+        )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS purchases (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                account_id INTEGER NOT NULL,
+                number TEXT NOT NULL,
+                country TEXT NOT NULL,
+                price REAL NOT NULL,
+                account_type TEXT NOT NULL,
+                otp TEXT,
+                status TEXT DEFAULT 'pending_otp',
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS deposit_requests (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    screenshot_file_id TEXT,
-                    details TEXT NOT NULL,
-                    deposit_type TEXT DEFAULT 'deposit_1',
-                    status TEXT DEFAULT 'pending',
-                    reviewed_by INTEGER,
-                    credited_amount REAL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    reviewed_at DATETIME
-                )
-                """
+            """
+        )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS deposit_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                screenshot_file_id TEXT,
+                details TEXT NOT NULL,
+                deposit_type TEXT DEFAULT 'deposit_1',
+                status TEXT DEFAULT 'pending',
+                reviewed_by INTEGER,
+                credited_amount REAL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                reviewed_at DATETIME
             )
+            """
+        )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS problems (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                status TEXT DEFAULT 'open',
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        await self._safe_add_column(db, "users", "deposit_1", "REAL DEFAULT 0")
+        await self._safe_add_column(db, "users", "deposit_2", "REAL DEFAULT 0")
+        await self._safe_add_column(db, "accounts", "tg_add_id", "INTEGER")
+        await self._safe_add_column(db, "accounts", "login_status", "TEXT DEFAULT 'pending'")
+        await self._safe_add_column(db, "deposit_requests", "deposit_type", "TEXT DEFAULT 'deposit_1'")
+
+    async def _migrate_hot_indexes(self, db):
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_accounts_stock ON accounts(account_type, status, country, id)"
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_purchases_number ON purchases(number, id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id, id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_deposit_requests_status ON deposit_requests(status)")
+        await db.execute("ANALYZE")
+
+    async def _migrate_broadcast_jobs(self, db):
+        await self._safe_add_column(db, "users", "blocked", "INTEGER DEFAULT 0")
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                created_by INTEGER NOT NULL,
+                status TEXT DEFAULT 'running',
+                cursor INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                progress_chat_id INTEGER,
+                progress_message_id INTEGER,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                finished_at DATETIME
+            )
+            """
+        )
+
+    async def _migrate_media_cache(self, db):
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media_cache (
+                source TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (source, content_hash)
+            )
+            """
+        )
+
+    async def _migrate_fsm_storage(self, db):
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated ON fsm_storage(updated_at)")
+
+    async def _migrate_account_number_index(self, db):
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_accounts_number ON accounts(number)")
+
+    async def _migrate_account_holds(self, db):
+        await self._safe_add_column(db, "accounts", "held_by", "INTEGER")
+        await self._safe_add_column(db, "accounts", "held_until", "REAL")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_accounts_holds ON accounts(held_until) WHERE status = 'held'")
+
+    async def _migrate_wallet_ledger(self, db):
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS wallet_ledger (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                wallet TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                amount INTEGER NOT NULL,
+                balance_after INTEGER NOT NULL,
+                purchase_id INTEGER,
+                deposit_request_id INTEGER,
+                actor_id INTEGER,
+                note TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_wallet_ledger_user ON wallet_ledger(user_id, id)")
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS wallet_balances (
+                user_id INTEGER NOT NULL,
+                wallet TEXT NOT NULL,
+                balance INTEGER NOT NULL DEFAULT 0 CHECK (balance >= 0),
+                PRIMARY KEY (user_id, wallet)
+            ) WITHOUT ROWID
+            """
+        )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS wallet_snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                last_entry_id INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS wallet_snapshot_balances (
+                snapshot_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                wallet TEXT NOT NULL,
+                balance INTEGER NOT NULL,
+                PRIMARY KEY (snapshot_id, user_id, wallet)
+            ) WITHOUT ROWID
+            """
+        )
+        # The REAL users.deposit_* columns become opening entries and are not written again.
+        for wallet in WALLETS:
             await db.execute(
+                f"""
+                INSERT INTO wallet_ledger(user_id, wallet, kind, amount, balance_after, note)
+                SELECT user_id, '{wallet}', 'opening', units, units, 'migrated from users.{wallet}'
+                FROM (SELECT user_id, CAST(ROUND({wallet} * {MINOR_UNITS}) AS INTEGER) AS units FROM users)
+                WHERE units > 0
                 """
-                CREATE TABLE IF NOT EXISTS problems (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    message TEXT NOT NULL,
-                    status TEXT DEFAULT 'open',
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-                """
             )
-            await self._safe_add_column(db, "users", "deposit_1", "REAL DEFAULT 0")
-            await self._safe_add_column(db, "users", "deposit_2", "REAL DEFAULT 0")
-            await self._safe_add_column(db, "accounts", "tg_add_id", "INTEGER")
-            await self._safe_add_column(db, "accounts", "login_status", "TEXT DEFAULT 'pending'")
-            await self._safe_add_column(db, "deposit_requests", "deposit_type", "TEXT DEFAULT 'deposit_1'")
-            await db.commit()
+        await db.execute(
+            """
+            INSERT INTO wallet_balances(user_id, wallet, balance)
+            SELECT user_id, wallet, balance_after FROM wallet_ledger WHERE kind = 'opening'
+            """
+        )
+
+    async def _migrate_country_registry(self, db):
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS countries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE
+            )
+            """
+        )
+        await db.execute("INSERT OR IGNORE INTO countries(name) SELECT DISTINCT country FROM accounts ORDER BY country")
+
+    async def _migrate_deposit_review_index(self, db):
+        # (status, id) serves the /pending keyset pages; the plain status index becomes redundant.
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_deposit_requests_review ON deposit_requests(status, id)")
+        await db.execute("DROP INDEX IF EXISTS idx_deposit_requests_status")
+
+    async def _migrate_user_stats(self, db):
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id INTEGER PRIMARY KEY,
+                orders INTEGER NOT NULL DEFAULT 0,
+                spent INTEGER NOT NULL DEFAULT 0,
+                pending_otps INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        # Triggers keep the aggregates in the same transaction as whichever statement
+        # inserts a purchase or moves it in or out of pending_otp.
+        await db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_purchases_stats_insert AFTER INSERT ON purchases
+            BEGIN
+                INSERT INTO user_stats(user_id, orders, spent, pending_otps)
+                VALUES (NEW.user_id, 1, CAST(ROUND(NEW.price * {MINOR_UNITS}) AS INTEGER), NEW.status = 'pending_otp')
+                ON CONFLICT(user_id) DO UPDATE SET
+                    orders = orders + 1,
+                    spent = spent + excluded.spent,
+                    pending_otps = pending_otps + excluded.pending_otps;
+            END
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_purchases_stats_status AFTER UPDATE OF status ON purchases
+            WHEN (OLD.status = 'pending_otp') != (NEW.status = 'pending_otp')
+            BEGIN
+                UPDATE user_stats
+                SET pending_otps = pending_otps + (NEW.status = 'pending_otp') - (OLD.status = 'pending_otp')
+                WHERE user_id = NEW.user_id;
+            END
+            """
+        )
+        await db.execute(
+            f"""
+            INSERT OR REPLACE INTO user_stats(user_id, orders, spent, pending_otps)
+            SELECT user_id, COUNT(*), SUM(CAST(ROUND(price * {MINOR_UNITS}) AS INTEGER)), SUM(status = 'pending_otp')
+            FROM purchases
+            GROUP BY user_id
+            """
+        )
+
+    async def _migrate_pending_otp_index(self, db):
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_purchases_pending_otp ON purchases(created_at) WHERE status = 'pending_otp'"
+        )
+
+    async def _migrate_stock_changes(self, db):
+        # Every accounts write lands here so other processes can replay it into their StockCatalog.
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stock_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                account_id INTEGER NOT NULL,
+                created_at REAL NOT NULL DEFAULT (strftime('%s', 'now'))
+            )
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_accounts_stock_insert AFTER INSERT ON accounts
+            BEGIN
+                INSERT INTO stock_changes(account_id) VALUES (NEW.id);
+            END
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_accounts_stock_update
+            AFTER UPDATE OF number, country, price, account_type, status, tg_add_id, login_status ON accounts
+            BEGIN
+                INSERT INTO stock_changes(account_id) VALUES (NEW.id);
+            END
+            """
+        )
+
+    async def _migrate_sales_rollups(self, db):
+        # Day x account_type x country counters kept by triggers, so /stats never scans history.
+        # Deposits are not tied to a product and use account_type = country = ''. remaining is
+        # the unsold stock (available or held) at the last change that day; NULL means no change.
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sales_rollups (
+                day TEXT NOT NULL,
+                account_type TEXT NOT NULL,
+                country TEXT NOT NULL,
+                units INTEGER NOT NULL DEFAULT 0,
+                revenue INTEGER NOT NULL DEFAULT 0,
+                deposit_count INTEGER NOT NULL DEFAULT 0,
+                deposits INTEGER NOT NULL DEFAULT 0,
+                remaining INTEGER,
+                PRIMARY KEY (day, account_type, country)
+            ) WITHOUT ROWID
+            """
+        )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stock_levels (
+                account_type TEXT NOT NULL,
+                country TEXT NOT NULL,
+                remaining INTEGER NOT NULL,
+                PRIMARY KEY (account_type, country)
+            ) WITHOUT ROWID
+            """
+        )
+        await db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_purchases_rollup AFTER INSERT ON purchases
+            BEGIN
+                INSERT INTO sales_rollups(day, account_type, country, units, revenue)
+                VALUES (date(NEW.created_at), NEW.account_type, NEW.country, 1, CAST(ROUND(NEW.price * {MINOR_UNITS}) AS INTEGER))
+                ON CONFLICT(day, account_type, country) DO UPDATE SET
+                    units = units + 1,
+                    revenue = revenue + excluded.revenue;
+            END
+            """
+        )
+        await db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_deposits_rollup AFTER UPDATE OF status ON deposit_requests
+            WHEN NEW.status = 'credited' AND OLD.status != 'credited'
+            BEGIN
+                INSERT INTO sales_rollups(day, account_type, country, deposit_count, deposits)
+                VALUES (date(NEW.reviewed_at), '', '', 1, CAST(ROUND(NEW.credited_amount * {MINOR_UNITS}) AS INTEGER))
+                ON CONFLICT(day, account_type, country) DO UPDATE SET
+                    deposit_count = deposit_count + 1,
+                    deposits = deposits + excluded.deposits;
+            END
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_accounts_rollup_insert AFTER INSERT ON accounts
+            WHEN NEW.status IN ('available', 'held')
+            BEGIN
+                INSERT INTO stock_levels(account_type, country, remaining)
+                VALUES (NEW.account_type, NEW.country, 1)
+                ON CONFLICT(account_type, country) DO UPDATE SET remaining = remaining + 1;
+                INSERT INTO sales_rollups(day, account_type, country, remaining)
+                SELECT date('now'), account_type, country, remaining FROM stock_levels
+                WHERE account_type = NEW.account_type AND country = NEW.country
+                ON CONFLICT(day, account_type, country) DO UPDATE SET remaining = excluded.remaining;
+            END
+            """
+        )
+        await db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_accounts_rollup_status AFTER UPDATE OF status ON accounts
+            WHEN (OLD.status IN ('available', 'held')) != (NEW.status IN ('available', 'held'))
+            BEGIN
+                INSERT INTO stock_levels(account_type, country, remaining)
+                VALUES (NEW.account_type, NEW.country, (NEW.status IN ('available', 'held')) - (OLD.status IN ('available', 'held')))
+                ON CONFLICT(account_type, country) DO UPDATE SET remaining = remaining + excluded.remaining;
+                INSERT INTO sales_rollups(day, account_type, country, remaining)
+                SELECT date('now'), account_type, country, remaining FROM stock_levels
+                WHERE account_type = NEW.account_type AND country = NEW.country
+                ON CONFLICT(day, account_type, country) DO UPDATE SET remaining = excluded.remaining;
+            END
+            """
+        )
+        await db.execute(
+            f"""
+            INSERT INTO sales_rollups(day, account_type, country, units, revenue)
+            SELECT date(created_at), account_type, country, COUNT(*), SUM(CAST(ROUND(price * {MINOR_UNITS}) AS INTEGER))
+            FROM purchases
+            GROUP BY 1, 2, 3
+            """
+        )
+        await db.execute(
+            f"""
+            INSERT INTO sales_rollups(day, account_type, country, deposit_count, deposits)
+            SELECT date(COALESCE(reviewed_at, created_at)), '', '', COUNT(*),
+                   SUM(CAST(ROUND(COALESCE(credited_amount, 0) * {MINOR_UNITS}) AS INTEGER))
+            FROM deposit_requests
+            WHERE status = 'credited'
+            GROUP BY 1
+            """
+        )
+        await db.execute(
+            """
+            INSERT OR REPLACE INTO stock_levels(account_type, country, remaining)
+            SELECT account_type, country, COUNT(*) FROM accounts
+            WHERE status IN ('available', 'held')
+            GROUP BY account_type, country
+            """
+        )
+        await db.execute(
+            """
+            INSERT INTO sales_rollups(day, account_type, country, remaining)
+            SELECT date('now'), account_type, country, remaining FROM stock_levels WHERE true
+            ON CONFLICT(day, account_type, country) DO UPDATE SET remaining = excluded.remaining
+            """
+        )
+
+    async def _migrate_broadcast_leases(self, db):
+        await self._safe_add_column(db, "broadcast_jobs", "owner", "TEXT")
+        await self._safe_add_column(db, "broadcast_jobs", "lease_until", "REAL")
+
+    async def _migrate_job_runs(self, db):
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS job_runs (
+                name TEXT PRIMARY KEY,
+                last_run REAL NOT NULL
+            )
+            """
+        )
+
+    async def _migrate_price_index(self, db):
+        # Allocation is cheapest first; the index answers it without touching the table and still
+        # serves every (account_type, status, country) lookup idx_accounts_stock did.
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_accounts_price ON accounts(account_type, status, country, price, id)"
+        )
+        await db.execute("DROP INDEX IF EXISTS idx_accounts_stock")
+        await db.execute("ANALYZE accounts")
+
+    MIGRATIONS = (
+        _migrate_base_schema,
+        _migrate_hot_indexes,
+        _migrate_broadcast_jobs,
+        _migrate_media_cache,
+        _migrate_fsm_storage,
+        _migrate_account_number_index,
+        _migrate_account_holds,
+        _migrate_wallet_ledger,
+        _migrate_country_registry,
+        _migrate_deposit_review_index,
+        _migrate_user_stats,
+        _migrate_pending_otp_index,
+        _migrate_stock_changes,
+        _migrate_sales_rollups,
+        _migrate_price_index,
+        _migrate_broadcast_leases,
+        _migrate_job_runs,
+    )
 
     async def _safe_add_column(self, db, table: str, column: str, ddl: str):
         cur = await db.execute(f"PRAGMA table_info({table})")
@@ -194,237 +1125,1662 @@ class Database:
             await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
 
     async def upsert_user(self, message: Message):
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
+        user_id = message.from_user.id
+        profile = (message.from_user.username, message.from_user.first_name)
+        known = self.seen_users.get(user_id)
+        if known == profile:
+            self.seen_users.skipped += 1
+            return
+        if known is not None:
+            self.seen_users.pending[user_id] = profile
+            self.seen_users.remember(user_id, profile)
+            return
+        # Unknown here (new, evicted or marked blocked): write now so broadcasts see the user.
+        await self._upsert_profiles([(user_id, *profile)])
+        self.seen_users.remember(user_id, profile)
+
+    async def flush_users(self):
+        seen = self.seen_users
+        if not seen.pending or seen.flushing:
+            return
+        seen.flushing, seen.pending = seen.pending, {}
+        try:
+            await self._upsert_profiles([(user_id, *profile) for user_id, profile in seen.flushing.items()])
+        except BaseException:
+            seen.pending = {**seen.flushing, **seen.pending}
+            raise
+        finally:
+            seen.flushing = {}
+
+    async def _upsert_profiles(self, rows: list[tuple[int, Optional[str], Optional[str]]]):
+        async with self.write() as db:
+            await db.executemany(
                 """
                 INSERT INTO users(user_id, username, first_name)
                 VALUES (?, ?, ?)
                 ON CONFLICT(user_id) DO UPDATE SET
                     username=excluded.username,
-                    first_name=excluded.first_name
+                    first_name=excluded.first_name,
+                    blocked=0
                 """,
-                (
-                    message.from_user.id,
-                    message.from_user.username,
-                    message.from_user.first_name,
-                ),
+                rows,
             )
-            await db.commit()
 
-    async def all_users(self) -> list[int]:
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute("SELECT user_id FROM users")
+    async def add_account(
+        self,
+        number: str,
+        country: str,
+        price: float,
+        account_type: str,
+        added_by: int,
+        tg_add_id: Optional[int] = None,
+    ) -> int:
+        async with self.write() as db:
+            cur = await db.execute(
+                """
+                INSERT INTO accounts(number, country, price, account_type, added_by, tg_add_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (number, country.lower(), price, account_type, added_by, tg_add_id),
+            )
+            account_id = cur.lastrowid
+        self.stock.add(Account(account_id, number, country.lower(), price, account_type, "available", tg_add_id))
+        return account_id
+
+    async def reserve_account(self, user_id: int, account_type: str, country: str, seconds: float) -> Optional[Account]:
+        columns = "id, number, country, price, account_type, status, tg_add_id, login_status"
+        until = time.time() + seconds
+        async with self.write() as db:
+            cur = await db.execute(
+                f"""
+                UPDATE accounts SET held_until = ?
+                WHERE account_type = ? AND country = ? AND status = 'held' AND held_by = ?
+                RETURNING {columns}
+                """,
+                (until, account_type, country.lower(), user_id),
+            )
             rows = await cur.fetchall()
-            return [r[0] for r in rows]
+            if rows:
+                return Account(*rows[0])
+            # One hold per buyer: switching country hands the previous number back.
+            cur = await db.execute(
+                f"""
+                UPDATE accounts SET status = 'available', held_by = NULL, held_until = NULL
+                WHERE status = 'held' AND held_by = ?
+                RETURNING {columns}
+                """,
+                (user_id,),
+            )
+            released = [Account(*row) for row in await cur.fetchall()]
+            cur = await db.execute(
+                f"""
+                UPDATE accounts SET status = 'held', held_by = ?, held_until = ?
+                WHERE id = (
+                    SELECT id FROM accounts
+                    WHERE account_type = ? AND country = ? AND status = 'available'
+                    ORDER BY price ASC, id ASC
+                    LIMIT 1
+                )
+                RETURNING {columns}
+                """,
+                (user_id, until, account_type, country.lower()),
+            )
+            row = await cur.fetchone()
+        for account in released:
+            self.stock.add(account)
+        if not row:
+            return None
+        account = Account(*row)
+        self.stock.remove(account.account_type, account.country, account.id)
+        return account
 
-    async def add_account(self, number: str, country: str, price: float, account_type: str, added_by: int):
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
+    async def set_price(self, account_type: str, country: str, price: float) -> int:
+        # Unsold stock only: held numbers too, so a hold that lapses does not bring back the old price.
+        async with self.write() as db:
+            cur = await db.execute(
                 """
-                INSERT INTO accounts(number, country, price, account_type, added_by)
-                VALUES (?, ?, ?, ?, ?)
+                UPDATE accounts SET price = ?
+                WHERE account_type = ? AND country = ? AND status IN ('available', 'held') AND price != ?
+                RETURNING id, number, country, price, account_type, status, tg_add_id, login_status
                 """,
-                (number, country.lower(), price, account_type, added_by),
+                (price, account_type, country.lower(), price),
             )
-            await db.commit()
+            repriced = [Account(*row) for row in await cur.fetchall()]
+        for account in repriced:
+            self.stock.remove(account.account_type, account.country, account.id)
+            if account.status == "available":
+                self.stock.add(account)
+        return len(repriced)
+
+    async def release_expired_holds(self) -> int:
+        async with self.write() as db:
+            cur = await db.execute(
+                """
+                UPDATE accounts SET status = 'available', held_by = NULL, held_until = NULL
+                WHERE status = 'held' AND held_until < ?
+                RETURNING id, number, country, price, account_type, status, tg_add_id, login_status
+                """,
+                (time.time(),),
+            )
+            released = [Account(*row) for row in await cur.fetchall()]
+        for account in released:
+            self.stock.add(account)
+        return len(released)
 
-    async def countries_with_stock(self, account_type: str) -> list[tuple[str, int, float]]:
-        async with aiosqlite.connect(self.path) as db:
+    async def expire_pending_otps(self, older_than_seconds: float) -> int:
+        async with self.write() as db:
             cur = await db.execute(
                 """
-                SELECT country, COUNT(*), MIN(price)
-                FROM accounts
-                WHERE account_type = ? AND status = 'available'
-                GROUP BY country
-                ORDER BY country ASC
+                UPDATE purchases SET status = 'otp_expired'
+                WHERE status = 'pending_otp' AND created_at < datetime('now', ?)
                 """,
-                (account_type,),
+                (f"-{int(older_than_seconds)} seconds",),
             )
-            return await cur.fetchall()
+            return cur.rowcount
+
+    async def stale_deposit_requests(self, older_than_seconds: float) -> tuple[int, Optional[int]]:
+        async with self.read() as db:
+            cur = await db.execute(
+                """
+                SELECT COUNT(*), MIN(id) FROM deposit_requests
+                WHERE status = 'pending' AND created_at < datetime('now', ?)
+                """,
+                (f"-{int(older_than_seconds)} seconds",),
+            )
+            return await cur.fetchone()
+
+    async def optimize(self):
+        # PRAGMA optimize re-runs ANALYZE only for tables whose statistics have drifted. It runs in
+        # write() because ANALYZE upgrades a read to a write, which skips busy_timeout if another
+        # process committed in between.
+        async with self.write() as db:
+            await db.execute("PRAGMA optimize")
+
+    async def checkpoint(self) -> str:
+        # PASSIVE never waits: a long reader such as /export keeps its snapshot and writers keep
+        # committing. Frames a reader still needs are copied back on a later run.
+        async with self.read() as db:
+            cur = await db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            busy, frames, copied = await cur.fetchone()
+        if busy:
+            return "busy: another checkpoint is running"
+        if copied < frames:
+            return f"partial: {copied}/{frames} WAL frames, the rest are still in use by readers"
+        return f"{copied}/{frames} WAL frames"
+
+    async def import_accounts(self, rows: list["StockRow"], added_by: int) -> tuple[int, list["StockRow"]]:
+        async with self.write() as db:
+            # Only unsold rows count: a number that was sold before may be stocked again.
+            existing: set[str] = set()
+            numbers = [row.number for row in rows]
+            for i in range(0, len(numbers), 500):
+                chunk = numbers[i : i + 500]
+                cur = await db.execute(
+                    f"""
+                    SELECT number FROM accounts
+                    WHERE number IN ({','.join('?' * len(chunk))}) AND status IN ('available', 'held')
+                    """,
+                    chunk,
+                )
+                existing.update(r[0] for r in await cur.fetchall())
+            fresh = [row for row in rows if row.number not in existing]
+            duplicates = [row for row in rows if row.number in existing]
+
+            cur = await db.execute("SELECT COALESCE(MAX(id), 0) FROM accounts")
+            (last_id,) = await cur.fetchone()
+            await db.executemany(
+                """
+                INSERT INTO accounts(number, country, price, account_type, added_by, tg_add_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                [(r.number, r.country, r.price, r.account_type, added_by, r.tg_add_id) for r in fresh],
+            )
+            cur = await db.execute(
+                """
+                SELECT id, number, country, price, account_type, status, tg_add_id, login_status
+                FROM accounts WHERE id > ?
+                """,
+                (last_id,),
+            )
+            added = [Account(*row) for row in await cur.fetchall()]
+        for account in added:
+            self.stock.add(account)
+        return len(added), duplicates
 
-    async def first_available_for_country(self, account_type: str, country: str) -> Optional[Account]:
-        async with aiosqlite.connect(self.path) as db:
+    async def mark_account_logged_in(self, number: str):
+        async with self.write() as db:
             cur = await db.execute(
+                "UPDATE accounts SET login_status = 'logged_in' WHERE number = ? RETURNING id, account_type, country",
+                (number,),
+            )
+            rows = await cur.fetchall()
+        for account_id, account_type, country in rows:
+            account = self.stock.get(account_type, country, account_id)
+            if account:
+                account.login_status = "logged_in"
+
+    async def _load_stock(self):
+        self.stock.clear()
+        async with self.read() as db:
+            # Take the cursor first: changes racing the load are replayed again, which is harmless.
+            cur = await db.execute("SELECT COALESCE(MAX(id), 0) FROM stock_changes")
+            (self._stock_cursor,) = await cur.fetchone()
+            async with db.execute(
                 """
                 SELECT id, number, country, price, account_type, status, tg_add_id, login_status
                 FROM accounts
-                WHERE account_type = ? AND country = ? AND status = 'available'
-                ORDER BY id ASC
-                LIMIT 1
+                WHERE status = 'available'
+                """
+            ) as cur:
+                async for row in cur:
+                    self.stock.add(Account(*row))
+
+    async def sync_stock(self) -> int:
+        # Cluster workers sell from the same table; pull in what the others changed.
+        async with self.read() as db:
+            cur = await db.execute(
+                """
+                SELECT c.id, a.id, a.number, a.country, a.price, a.account_type, a.status, a.tg_add_id, a.login_status
+                FROM stock_changes c JOIN accounts a ON a.id = c.account_id
+                WHERE c.id > ?
+                ORDER BY c.id
                 """,
-                (account_type, country.lower()),
+                (self._stock_cursor,),
             )
-            row = await cur.fetchone()
+            rows = await cur.fetchall()
+        if not rows:
+            return 0
+        for _, *columns in rows:
+            account = Account(*columns)
+            self.stock.remove(account.account_type, account.country, account.id)
+            if account.status == "available":
+                self.stock.add(account)
+        self._stock_cursor = rows[-1][0]
+        return len(rows)
+
+    async def prune_stock_changes(self, older_than_seconds: float) -> int:
+        async with self.write() as db:
+            cur = await db.execute(
+                """
+                DELETE FROM stock_changes
+                WHERE id < COALESCE(
+                    (SELECT id FROM stock_changes WHERE created_at >= ? ORDER BY id LIMIT 1),
+                    (SELECT MAX(id) + 1 FROM stock_changes)
+                )
+                """,
+                (time.time() - older_than_seconds,),
+            )
+            return cur.rowcount
+
+    async def country_page(self, account_type: str, page: int, size: int = COUNTRY_PAGE_SIZE):
+        return self.stock.country_page(account_type, page, size)
+
+    async def _load_countries(self):
+        async with self.read() as db:
+            cur = await db.execute("SELECT id, name FROM countries")
+            rows = await cur.fetchall()
+        self._remember_countries(rows)
+
+    def _remember_countries(self, rows):
+        for country_id, name in rows:
+            self._country_ids[name] = country_id
+            self._country_names[country_id] = name
+
+    async def country_ids(self, names: list[str]) -> dict[str, int]:
+        missing = [name for name in names if name not in self._country_ids]
+        if missing:
+            # Ids are handed out once per name and never change, so old keyboards keep working.
+            rows = []
+            async with self.write() as db:
+                await db.executemany("INSERT OR IGNORE INTO countries(name) VALUES (?)", [(name,) for name in missing])
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i : i + 500]
+                    cur = await db.execute(
+                        f"SELECT id, name FROM countries WHERE name IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                    rows.extend(await cur.fetchall())
+            self._remember_countries(rows)
+        return {name: self._country_ids[name] for name in names}
+
+    async def country_name(self, country_id: int) -> Optional[str]:
+        name = self._country_names.get(country_id)
+        if name is None:
+            async with self.read() as db:
+                cur = await db.execute("SELECT name FROM countries WHERE id = ?", (country_id,))
+                row = await cur.fetchone()
             if not row:
                 return None
-            return Account(*row)
-
-    async def account_by_id(self, account_id: int) -> Optional[Account]:
-        async with aiosqlite.connect(self.path) as db:
+            name = row[0]
+            self._remember_countries([(country_id, name)])
+        return name
+
+    async def _wallet_units(self, db, user_id: int) -> tuple[int, int]:
+        cur = await db.execute("SELECT wallet, balance FROM wallet_balances WHERE user_id = ?", (user_id,))
+        balances = dict(await cur.fetchall())
+        return balances.get("deposit_1", 0), balances.get("deposit_2", 0)
+
+    async def _post_ledger_entry(
+        self,
+        db,
+        user_id: int,
+        wallet: str,
+        kind: str,
+        amount: int,
+        purchase_id: Optional[int] = None,
+        deposit_request_id: Optional[int] = None,
+        actor_id: Optional[int] = None,
+    ) -> Optional[int]:
+        # Runs inside the caller's transaction so the entry and the cached balance move together.
+        if amount >= 0:
             cur = await db.execute(
                 """
-                SELECT id, number, country, price, account_type, status
-                FROM accounts WHERE id = ?
+                INSERT INTO wallet_balances(user_id, wallet, balance) VALUES (?, ?, ?)
+                ON CONFLICT(user_id, wallet) DO UPDATE SET balance = balance + excluded.balance
+                RETURNING balance
                 """,
-                (account_id,),
+                (user_id, wallet, amount),
             )
-            row = await cur.fetchone()
-            return Account(*row) if row else None
+        else:
+            cur = await db.execute(
+                """
+                UPDATE wallet_balances SET balance = balance + ?
+                WHERE user_id = ? AND wallet = ? AND balance + ? >= 0
+                RETURNING balance
+                """,
+                (amount, user_id, wallet, amount),
+            )
+        row = await cur.fetchone()
+        if not row:
+            return None
+        await db.execute(
+            """
+            INSERT INTO wallet_ledger(user_id, wallet, kind, amount, balance_after, purchase_id, deposit_request_id, actor_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (user_id, wallet, kind, amount, row[0], purchase_id, deposit_request_id, actor_id),
+        )
+        return row[0]
 
     async def get_wallets(self, user_id: int) -> tuple[float, float]:
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute("SELECT deposit_1, deposit_2 FROM users WHERE user_id = ?", (user_id,))
-            row = await cur.fetchone()
-            if not row:
-                return 0.0, 0.0
-            return float(row[0] or 0), float(row[1] or 0)
+        async with self.read() as db:
+            dep1, dep2 = await self._wallet_units(db, user_id)
+        return from_minor(dep1), from_minor(dep2)
 
-    async def credit_wallet(self, user_id: int, wallet: str, amount: float):
-        if wallet not in {"deposit_1", "deposit_2"}:
+    async def credit_wallet(self, user_id: int, wallet: str, amount: float, actor_id: Optional[int] = None) -> bool:
+        if wallet not in WALLETS:
             wallet = "deposit_1"
-        async with aiosqlite.connect(self.path) as db:
+        units = to_minor(amount)
+        async with self.write() as db:
             await db.execute("INSERT OR IGNORE INTO users(user_id) VALUES(?)", (user_id,))
-            await db.execute(f"UPDATE users SET {wallet} = COALESCE({wallet}, 0) + ? WHERE user_id = ?", (amount, user_id))
-            await db.commit()
-
-    async def purchase(self, user_id: int, account: Account) -> tuple[Optional[int], str | None]:
-        dep1, dep2 = await self.get_wallets(user_id)
-        wallet_used = None
-        if account.account_type == "tg2":
-            if dep1 >= account.price:
-                wallet_used = "deposit_1"
-        elif account.account_type == "tg1":
-            if dep2 >= account.price:
-                wallet_used = "deposit_2"
-        elif account.account_type == "whatsapp":
-            if dep1 >= account.price:
-                wallet_used = "deposit_1"
-            elif dep2 >= account.price:
-                wallet_used = "deposit_2"
-
-        if not wallet_used:
-            return None, None
-
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(f"UPDATE users SET {wallet_used} = {wallet_used} - ? WHERE user_id = ?", (account.price, user_id))
-            await db.execute("UPDATE accounts SET status = 'sold' WHERE id = ?", (account.id,))
+            kind = "credit" if units >= 0 else "adjustment"
+            return await self._post_ledger_entry(db, user_id, wallet, kind, units, actor_id=actor_id) is not None
+
+    async def set_wallet_balance(self, user_id: int, wallet: str, amount: float, actor_id: Optional[int] = None) -> float:
+        async with self.write() as db:
+            await db.execute("INSERT OR IGNORE INTO users(user_id) VALUES(?)", (user_id,))
+            dep1, dep2 = await self._wallet_units(db, user_id)
+            current = dep1 if wallet == "deposit_1" else dep2
+            target = max(0, to_minor(amount))
+            if target != current:
+                await self._post_ledger_entry(db, user_id, wallet, "adjustment", target - current, actor_id=actor_id)
+        return from_minor(current)
+
+    async def ledger_entries(self, user_id: int, limit: int = 15) -> list[tuple]:
+        async with self.read() as db:
             cur = await db.execute(
                 """
-                INSERT INTO purchases(user_id, account_id, number, country, price, account_type)
-                VALUES (?, ?, ?, ?, ?, ?)
+                SELECT id, wallet, kind, amount, balance_after, purchase_id, deposit_request_id, created_at
+                FROM wallet_ledger WHERE user_id = ?
+                ORDER BY id DESC
+                LIMIT ?
                 """,
-                (user_id, account.id, account.number, account.country, account.price, account.account_type),
+                (user_id, limit),
             )
-            await db.commit()
-            return cur.lastrowid, wallet_used
+            return await cur.fetchall()
 
-    async def purchase_history(self, user_id: int) -> list[tuple]:
-        async with aiosqlite.connect(self.path) as db:
+    async def snapshot_wallets(self) -> int:
+        async with self.write() as db:
+            cur = await db.execute("SELECT id, last_entry_id FROM wallet_snapshots ORDER BY id DESC LIMIT 1")
+            previous_id, since = await cur.fetchone() or (0, 0)
+            cur = await db.execute("SELECT COALESCE(MAX(id), 0) FROM wallet_ledger")
+            (until,) = await cur.fetchone()
+            cur = await db.execute("INSERT INTO wallet_snapshots(last_entry_id) VALUES (?)", (until,))
+            snapshot_id = cur.lastrowid
+            # Built from the previous snapshot plus newer entries, never from wallet_balances,
+            # so drift in the cached balances cannot be baked into a snapshot.
+            await db.execute(
+                """
+                INSERT INTO wallet_snapshot_balances(snapshot_id, user_id, wallet, balance)
+                SELECT ?, user_id, wallet, SUM(amount) FROM (
+                    SELECT user_id, wallet, balance AS amount FROM wallet_snapshot_balances WHERE snapshot_id = ?
+                    UNION ALL
+                    SELECT user_id, wallet, amount FROM wallet_ledger WHERE id > ? AND id <= ?
+                )
+                GROUP BY user_id, wallet
+                """,
+                (snapshot_id, previous_id, since, until),
+            )
+            cur = await db.execute(
+                "SELECT id FROM wallet_snapshots ORDER BY id DESC LIMIT -1 OFFSET ?",
+                (WALLET_SNAPSHOTS_KEPT,),
+            )
+            stale = [r[0] for r in await cur.fetchall()]
+            for old_id in stale:
+                await db.execute("DELETE FROM wallet_snapshot_balances WHERE snapshot_id = ?", (old_id,))
+                await db.execute("DELETE FROM wallet_snapshots WHERE id = ?", (old_id,))
+            return snapshot_id
+
+    async def reconcile_wallets(self) -> tuple[int, list[tuple[int, str, float, float]]]:
+        async with self.read() as db:
+            cur = await db.execute("SELECT id, last_entry_id FROM wallet_snapshots ORDER BY id DESC LIMIT 1")
+            snapshot_id, since = await cur.fetchone() or (0, 0)
+            cur = await db.execute("SELECT COUNT(*) FROM wallet_ledger WHERE id > ?", (since,))
+            (scanned,) = await cur.fetchone()
             cur = await db.execute(
                 """
-                SELECT account_type, number, country, price, status, created_at
-                FROM purchases WHERE user_id = ?
-                ORDER BY id DESC
-                LIMIT 10
+                SELECT e.user_id, e.wallet, e.balance, COALESCE(b.balance, 0)
+                FROM (
+                    SELECT user_id, wallet, SUM(amount) AS balance FROM (
+                        SELECT user_id, wallet, balance AS amount FROM wallet_snapshot_balances WHERE snapshot_id = ?
+                        UNION ALL
+                        SELECT user_id, wallet, amount FROM wallet_ledger WHERE id > ?
+                        UNION ALL
+                        SELECT user_id, wallet, 0 FROM wallet_balances
+                    )
+                    GROUP BY user_id, wallet
+                ) e
+                LEFT JOIN wallet_balances b ON b.user_id = e.user_id AND b.wallet = e.wallet
+                WHERE e.balance != COALESCE(b.balance, 0)
                 """,
-                (user_id,),
+                (snapshot_id, since),
+            )
+            rows = await cur.fetchall()
+        return scanned, [(user_id, wallet, from_minor(expected), from_minor(actual)) for user_id, wallet, expected, actual in rows]
+
+    async def purchase(self, user_id: int, account_id: int) -> PurchaseResult:
+        result = await self._purchase_txn(user_id, account_id)
+        if result.account and result.status in {PURCHASE_OK, PURCHASE_SOLD}:
+            self.stock.remove(result.account.account_type, result.account.country, result.account.id)
+        return result
+
+    async def _purchase_txn(self, user_id: int, account_id: int) -> PurchaseResult:
+        try:
+            async with self.write() as db:
+                cur = await db.execute(
+                    """
+                    SELECT id, number, country, price, account_type, status, tg_add_id, login_status,
+                           held_by, held_until
+                    FROM accounts WHERE id = ?
+                    """,
+                    (account_id,),
+                )
+                row = await cur.fetchone()
+                if not row:
+                    return PurchaseResult(PURCHASE_NOT_FOUND)
+                account = Account(*row[:8])
+                held_by, held_until = row[8:]
+                now = time.time()
+                if account.status == "held" and held_by != user_id and held_until >= now:
+                    return PurchaseResult(PURCHASE_HELD, account)
+                if account.status not in {"available", "held"}:
+                    return PurchaseResult(PURCHASE_SOLD, account)
+
+                dep1, dep2 = await self._wallet_units(db, user_id)
+                price = to_minor(account.price)
+                wallet_used = pick_wallet(account.account_type, price, dep1, dep2)
+                if not wallet_used:
+                    return PurchaseResult(PURCHASE_INSUFFICIENT, account, dep1=from_minor(dep1), dep2=from_minor(dep2))
+
+                # BEGIN IMMEDIATE already serialises writers; the guards make the
+                # statements themselves refuse a double sale or an overdraft.
+                cur = await db.execute(
+                    """
+                    UPDATE accounts SET status = 'sold', held_by = NULL, held_until = NULL
+                    WHERE id = ? AND (
+                        status = 'available'
+                        OR (status = 'held' AND (held_by = ? OR held_until < ?))
+                    )
+                    """,
+                    (account.id, user_id, now),
+                )
+                if cur.rowcount != 1:
+                    raise PurchaseAborted(PurchaseResult(PURCHASE_SOLD, account))
+                cur = await db.execute(
+                    """
+                    INSERT INTO purchases(user_id, account_id, number, country, price, account_type)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (user_id, account.id, account.number, account.country, account.price, account.account_type),
+                )
+                purchase_id = cur.lastrowid
+                balance = await self._post_ledger_entry(
+                    db, user_id, wallet_used, "debit", -price, purchase_id=purchase_id
+                )
+                if balance is None:
+                    raise PurchaseAborted(
+                        PurchaseResult(PURCHASE_INSUFFICIENT, account, dep1=from_minor(dep1), dep2=from_minor(dep2))
+                    )
+                if wallet_used == "deposit_1":
+                    dep1 = balance
+                else:
+                    dep2 = balance
+                return PurchaseResult(PURCHASE_OK, account, purchase_id, wallet_used, from_minor(dep1), from_minor(dep2))
+        except PurchaseAborted as exc:
+            return exc.result
+
+    async def profile(
+        self,
+        user_id: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: int = PROFILE_PAGE_SIZE,
+    ) -> ProfilePage:
+        # Keyset page on idx_purchases_user: "older" walks down from before_id, "newer" up from after_id.
+        newer = after_id is not None
+        cursor = after_id if newer else before_id if before_id is not None else 2**63 - 1
+        comparison, order = (">", "ASC") if newer else ("<", "DESC")
+        async with self.read() as db:
+            # Balances, aggregates and the page come back from one statement; the header
+            # row survives the LEFT JOIN even when the page is empty.
+            cur = await db.execute(
+                f"""
+                WITH head AS (
+                    SELECT
+                        (SELECT balance FROM wallet_balances WHERE user_id = :user AND wallet = 'deposit_1') AS dep1,
+                        (SELECT balance FROM wallet_balances WHERE user_id = :user AND wallet = 'deposit_2') AS dep2,
+                        s.orders, s.spent, s.pending_otps
+                    FROM (SELECT 1) LEFT JOIN user_stats s ON s.user_id = :user
+                ), page AS (
+                    SELECT id, account_type, number, country, price, status, created_at
+                    FROM purchases
+                    WHERE user_id = :user AND id {comparison} :cursor
+                    ORDER BY id {order}
+                    LIMIT :limit
+                )
+                SELECT head.*, page.* FROM head LEFT JOIN page
+                ORDER BY page.id {order}
+                """,
+                {"user": user_id, "cursor": cursor, "limit": limit + 1},
+            )
+            rows = await cur.fetchall()
+        dep1, dep2, orders, spent, pending_otps = rows[0][:5]
+        purchases = [row[5:] for row in rows if row[5] is not None]
+        more = len(purchases) > limit
+        purchases = purchases[:limit]
+        if newer:
+            purchases.reverse()
+        return ProfilePage(
+            dep1=from_minor(dep1 or 0),
+            dep2=from_minor(dep2 or 0),
+            orders=orders or 0,
+            spent=from_minor(spent or 0),
+            pending_otps=pending_otps or 0,
+            purchases=purchases,
+            has_older=more if not newer else True,
+            has_newer=more if newer else before_id is not None,
+        )
+
+    # Rows are read in primary key order and filtered on created_at, inclusive of both dates.
+    EXPORT_RANGE = "(:start IS NULL OR {0} >= :start) AND (:end IS NULL OR {0} < date(:end, '+1 day'))"
+    EXPORTS = {
+        "purchases": (
+            ("id", "user_id", "account_id", "account_type", "country", "number", "price", "status", "otp", "created_at"),
+            f"""
+            SELECT id, user_id, account_id, account_type, country, number, price, status, otp, created_at
+            FROM purchases WHERE {EXPORT_RANGE.format("created_at")} ORDER BY id
+            """,
+        ),
+        "deposits": (
+            ("id", "user_id", "deposit_type", "details", "status", "credited_amount", "reviewed_by", "created_at", "reviewed_at"),
+            f"""
+            SELECT id, user_id, deposit_type, details, status, credited_amount, reviewed_by, created_at, reviewed_at
+            FROM deposit_requests WHERE {EXPORT_RANGE.format("created_at")} ORDER BY id
+            """,
+        ),
+        "accounts": (
+            ("id", "account_type", "country", "number", "price", "status", "login_status", "tg_add_id", "added_by", "created_at"),
+            f"""
+            SELECT id, account_type, country, number, price, status, login_status, tg_add_id, added_by, created_at
+            FROM accounts WHERE {EXPORT_RANGE.format("created_at")} ORDER BY id
+            """,
+        ),
+        "users": (
+            ("user_id", "username", "first_name", "blocked", "deposit_1", "deposit_2", "orders", "spent", "created_at"),
+            f"""
+            SELECT u.user_id, u.username, u.first_name, COALESCE(u.blocked, 0),
+                   COALESCE((SELECT balance FROM wallet_balances WHERE user_id = u.user_id AND wallet = 'deposit_1'), 0) / {MINOR_UNITS}.0,
+                   COALESCE((SELECT balance FROM wallet_balances WHERE user_id = u.user_id AND wallet = 'deposit_2'), 0) / {MINOR_UNITS}.0,
+                   COALESCE(s.orders, 0), COALESCE(s.spent, 0) / {MINOR_UNITS}.0, u.created_at
+            FROM users u LEFT JOIN user_stats s ON s.user_id = u.user_id
+            WHERE {EXPORT_RANGE.format("u.created_at")} ORDER BY u.user_id
+            """,
+        ),
+    }
+
+    async def export_csv(self, kind: str, start: Optional[str], end: Optional[str], path: str) -> int:
+        # Own connection in a worker thread, so the pool and the event loop stay free. A WAL
+        # reader never takes the write lock; purchases keep committing while this streams.
+        return await asyncio.to_thread(self._export_csv, kind, start, end, path)
+
+    def _export_csv(self, kind: str, start: Optional[str], end: Optional[str], path: str) -> int:
+        header, sql = self.EXPORTS[kind]
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+            conn.execute("PRAGMA query_only = ON")
+            cur = conn.execute(sql, {"start": start, "end": end})
+            count = 0
+            with gzip.open(path, "wt", encoding="utf-8", newline="") as fh:
+                writer = csv.writer(fh)
+                writer.writerow(header)
+                for chunk in iter_chunks(cur, EXPORT_CHUNK_ROWS):
+                    writer.writerows([csv_cell(value) for value in row] for row in chunk)
+                    count += len(chunk)
+            return count
+        finally:
+            conn.close()
+
+    async def sales_stats(self, days: int) -> SalesStats:
+        # Reads only sales_rollups rows inside the window and stock_levels, never purchases.
+        since = f"-{days - 1} days"
+        async with self.read() as db:
+            cur = await db.execute(
+                """
+                SELECT day, SUM(units), SUM(revenue), SUM(deposit_count), SUM(deposits)
+                FROM sales_rollups
+                WHERE day >= date('now', ?)
+                GROUP BY day
+                ORDER BY day DESC
+                """,
+                (since,),
+            )
+            day_rows = await cur.fetchall()
+            cur = await db.execute(
+                """
+                SELECT account_type, country, SUM(units), SUM(revenue)
+                FROM sales_rollups
+                WHERE day >= date('now', ?) AND account_type != ''
+                GROUP BY account_type, country
+                HAVING SUM(units) > 0
+                """,
+                (since,),
+            )
+            product_rows = await cur.fetchall()
+            cur = await db.execute(
+                """
+                SELECT account_type, SUM(remaining), COUNT(*)
+                FROM stock_levels
+                WHERE remaining > 0
+                GROUP BY account_type
+                ORDER BY account_type
+                """
+            )
+            stock = await cur.fetchall()
+        by_type: dict[str, list[int]] = {}
+        for account_type, _, units, revenue in product_rows:
+            totals = by_type.setdefault(account_type, [0, 0])
+            totals[0] += units
+            totals[1] += revenue
+        top = sorted(product_rows, key=lambda row: row[3], reverse=True)[:STATS_TOP_COUNTRIES]
+        return SalesStats(
+            days=[(day, units, from_minor(revenue), count, from_minor(deposits)) for day, units, revenue, count, deposits in day_rows],
+            by_type=[(account_type, units, from_minor(revenue)) for account_type, (units, revenue) in sorted(by_type.items())],
+            top_countries=[(account_type, country, units, from_minor(revenue)) for account_type, country, units, revenue in top],
+            stock=stock,
+        )
+
+    async def set_otps(self, otps: dict[str, str]) -> dict[str, tuple[int, int]]:
+        matched: dict[str, tuple[int, int]] = {}
+        numbers = list(otps)
+        async with self.write() as db:
+            for i in range(0, len(numbers), 500):
+                chunk = numbers[i : i + 500]
+                # SQLite returns user_id from the row that supplied MAX(id): the latest sale of each number.
+                cur = await db.execute(
+                    f"""
+                    SELECT number, MAX(id), user_id FROM purchases
+                    WHERE number IN ({','.join('?' * len(chunk))})
+                    GROUP BY number
+                    """,
+                    chunk,
+                )
+                for number, purchase_id, user_id in await cur.fetchall():
+                    matched[number] = (purchase_id, user_id)
+            await db.executemany(
+                "UPDATE purchases SET otp = ?, status = 'otp_sent' WHERE id = ?",
+                [(otps[number], purchase_id) for number, (purchase_id, _) in matched.items()],
+            )
+        return matched
+
+    async def add_problem(self, user_id: int, msg: str):
+        async with self.write() as db:
+            await db.execute("INSERT INTO problems(user_id, message) VALUES (?, ?)", (user_id, msg))
+
+    async def create_deposit_request(self, user_id: int, details: str, screenshot_file_id: str | None, deposit_type: str) -> int:
+        async with self.write() as db:
+            cur = await db.execute(
+                """
+                INSERT INTO deposit_requests(user_id, screenshot_file_id, details, deposit_type)
+                VALUES (?, ?, ?, ?)
+                """,
+                (user_id, screenshot_file_id, details, deposit_type),
+            )
+            return cur.lastrowid
+
+    async def get_deposit_request(self, request_id: int) -> Optional[tuple]:
+        async with self.read() as db:
+            cur = await db.execute(
+                """
+                SELECT id, user_id, screenshot_file_id, details, deposit_type, status
+                FROM deposit_requests
+                WHERE id = ?
+                """,
+                (request_id,),
+            )
+            return await cur.fetchone()
+
+    async def mark_deposit_decision(self, request_id: int, owner_id: int, status: str) -> bool:
+        async with self.write() as db:
+            cur = await db.execute(
+                """
+                UPDATE deposit_requests
+                SET status = ?, reviewed_by = ?, reviewed_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'pending'
+                """,
+                (status, owner_id, request_id),
+            )
+            return cur.rowcount > 0
+
+    async def deposit_requests_page(self, status: str, after_id: int, limit: int) -> list[tuple]:
+        async with self.read() as db:
+            cur = await db.execute(
+                """
+                SELECT id, user_id, deposit_type, details, created_at
+                FROM deposit_requests
+                WHERE status = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+                """,
+                (status, after_id, limit),
             )
             return await cur.fetchall()
 
-    async def set_otp_and_get_user(self, number: str, otp: str) -> Optional[tuple[int, int]]:
-        async with aiosqlite.connect(self.path) as db:
+    async def apply_deposit_credit(self, request_id: int, owner_id: int, amount: float) -> Optional[int]:
+        async with self.write() as db:
+            status, user_id = await self._credit_deposit(db, request_id, owner_id, amount)
+        if status == DEPOSIT_NOT_FOUND:
+            return None
+        if status == DEPOSIT_ALREADY_CREDITED:
+            return -1
+        return user_id
+
+    async def apply_deposit_credits(self, credits: dict[int, float], owner_id: int) -> dict[int, tuple[str, Optional[int]]]:
+        async with self.write() as db:
+            return {
+                request_id: await self._credit_deposit(db, request_id, owner_id, amount)
+                for request_id, amount in credits.items()
+            }
+
+    async def _credit_deposit(self, db, request_id: int, owner_id: int, amount: float) -> tuple[str, Optional[int]]:
+        cur = await db.execute(
+            """
+            UPDATE deposit_requests
+            SET status = 'credited', reviewed_by = ?, credited_amount = ?, reviewed_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status != 'credited'
+            RETURNING user_id, deposit_type
+            """,
+            (owner_id, amount, request_id),
+        )
+        row = await cur.fetchone()
+        if not row:
+            cur = await db.execute("SELECT user_id FROM deposit_requests WHERE id = ?", (request_id,))
+            row = await cur.fetchone()
+            return (DEPOSIT_ALREADY_CREDITED, row[0]) if row else (DEPOSIT_NOT_FOUND, None)
+        user_id, deposit_type = row
+        if deposit_type not in WALLETS:
+            deposit_type = "deposit_1"
+        await db.execute("INSERT OR IGNORE INTO users(user_id) VALUES(?)", (user_id,))
+        await self._post_ledger_entry(
+            db, user_id, deposit_type, "credit", to_minor(amount), deposit_request_id=request_id, actor_id=owner_id
+        )
+        return DEPOSIT_CREDITED, user_id
+
+    async def solve_problem(self, problem_id: int) -> bool:
+        async with self.write() as db:
+            cur = await db.execute("UPDATE problems SET status='closed' WHERE id = ?", (problem_id,))
+            return cur.rowcount > 0
+
+    async def create_broadcast_job(self, text: str, created_by: int, owner: str, lease_seconds: float) -> "BroadcastJob":
+        async with self.write() as db:
+            cur = await db.execute("SELECT COUNT(*) FROM users WHERE COALESCE(blocked, 0) = 0")
+            (total,) = await cur.fetchone()
             cur = await db.execute(
+                "INSERT INTO broadcast_jobs(text, created_by, total, owner, lease_until) VALUES (?, ?, ?, ?, ?)",
+                (text, created_by, total, owner, time.time() + lease_seconds),
+            )
+            return BroadcastJob(cur.lastrowid, text, created_by, total=total)
+
+    async def set_broadcast_progress_message(self, job_id: int, chat_id: int, message_id: int):
+        async with self.write() as db:
+            await db.execute(
+                "UPDATE broadcast_jobs SET progress_chat_id = ?, progress_message_id = ? WHERE id = ?",
+                (chat_id, message_id, job_id),
+            )
+
+    async def load_fsm_record(self, key: str) -> Optional[tuple[Optional[str], str, float]]:
+        async with self.read() as db:
+            cur = await db.execute("SELECT state, data, updated_at FROM fsm_storage WHERE key = ?", (key,))
+            return await cur.fetchone()
+
+    async def save_fsm_record(self, key: str, state: Optional[str], data: str, updated_at: float):
+        async with self.write() as db:
+            if state is None and data == "{}":
+                await db.execute("DELETE FROM fsm_storage WHERE key = ?", (key,))
+                return
+            await db.execute(
                 """
-                SELECT id, user_id FROM purchases
-                WHERE number = ?
-                ORDER BY id DESC
-                LIMIT 1
+                INSERT INTO fsm_storage(key, state, data, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state=excluded.state,
+                    data=excluded.data,
+                    updated_at=excluded.updated_at
                 """,
-                (number,),
+                (key, state, data, updated_at),
+            )
+
+    async def purge_fsm_records(self, older_than: float) -> list[str]:
+        async with self.write() as db:
+            cur = await db.execute("DELETE FROM fsm_storage WHERE updated_at < ? RETURNING key", (older_than,))
+            return [r[0] for r in await cur.fetchall()]
+
+    async def get_media_file_id(self, source: str, content_hash: str) -> Optional[str]:
+        async with self.read() as db:
+            cur = await db.execute(
+                "SELECT file_id FROM media_cache WHERE source = ? AND content_hash = ?",
+                (source, content_hash),
             )
             row = await cur.fetchone()
-            if not row:
-                return None
-            purchase_id, user_id = row
-            await db.execute("UPDATE purchases SET otp = ?, status = 'otp_sent' WHERE id = ?", (otp, purchase_id))
-            await db.commit()
-            return purchase_id, user_id
+            return row[0] if row else None
+
+    async def save_media_file_id(self, source: str, content_hash: str, kind: str, file_id: str):
+        async with self.write() as db:
+            # A new hash means the file changed; ids for older contents are useless.
+            await db.execute("DELETE FROM media_cache WHERE source = ? AND content_hash != ?", (source, content_hash))
+            await db.execute(
+                """
+                INSERT INTO media_cache(source, content_hash, kind, file_id)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(source, content_hash) DO UPDATE SET
+                    kind=excluded.kind,
+                    file_id=excluded.file_id,
+                    updated_at=CURRENT_TIMESTAMP
+                """,
+                (source, content_hash, kind, file_id),
+            )
+
+    async def delete_media_file_id(self, source: str, content_hash: str):
+        async with self.write() as db:
+            await db.execute("DELETE FROM media_cache WHERE source = ? AND content_hash = ?", (source, content_hash))
+
+    async def claim_broadcast_jobs(self, owner: str, lease_seconds: float) -> list["BroadcastJob"]:
+        # Running jobs nobody holds a live lease on. One UPDATE claims them, so two instances
+        # starting together never both resume the same job from the same cursor.
+        now = time.time()
+        async with self.write() as db:
+            cur = await db.execute(
+                """
+                UPDATE broadcast_jobs SET owner = ?, lease_until = ?
+                WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?)
+                RETURNING id, text, created_by, status, cursor, total, sent, failed, blocked,
+                          progress_chat_id, progress_message_id
+                """,
+                (owner, now + lease_seconds, now),
+            )
+            rows = await cur.fetchall()
+        return sorted((BroadcastJob(*row) for row in rows), key=lambda job: job.id)
+
+    async def claim_job_run(self, name: str, min_gap: float) -> bool:
+        # Shared maintenance runs on whichever instance gets here first once min_gap has passed
+        # since the last run anywhere; everyone else skips this round.
+        now = time.time()
+        async with self.write() as db:
+            cur = await db.execute(
+                """
+                INSERT INTO job_runs(name, last_run) VALUES (?, ?)
+                ON CONFLICT(name) DO UPDATE SET last_run = excluded.last_run
+                WHERE job_runs.last_run <= ?
+                """,
+                (name, now, now - min_gap),
+            )
+            return cur.rowcount > 0
+
+    async def release_broadcast_jobs(self, owner: str):
+        async with self.write() as db:
+            await db.execute(
+                "UPDATE broadcast_jobs SET lease_until = NULL WHERE owner = ? AND status = 'running'",
+                (owner,),
+            )
+
+    async def broadcast_recipients(self, after_user_id: int, limit: int) -> list[int]:
+        async with self.read() as db:
+            cur = await db.execute(
+                """
+                SELECT user_id FROM users
+                WHERE user_id > ? AND COALESCE(blocked, 0) = 0
+                ORDER BY user_id ASC
+                LIMIT ?
+                """,
+                (after_user_id, limit),
+            )
+            return [r[0] for r in await cur.fetchall()]
+
+    async def save_broadcast_progress(
+        self, job: "BroadcastJob", blocked_user_ids: list[int], owner: str, lease_seconds: float
+    ) -> bool:
+        # Also renews the lease. False means another instance took the job over: stop sending.
+        async with self.write() as db:
+            if blocked_user_ids:
+                await db.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", [(uid,) for uid in blocked_user_ids])
+                # Their next /start must reach the table again to clear the flag.
+                self.seen_users.forget(blocked_user_ids)
+            cur = await db.execute(
+                """
+                UPDATE broadcast_jobs
+                SET status = ?, cursor = ?, sent = ?, failed = ?, blocked = ?,
+                    lease_until = CASE WHEN ? = 'running' THEN ? END,
+                    finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+                WHERE id = ? AND owner = ?
+                """,
+                (
+                    job.status, job.cursor, job.sent, job.failed, job.blocked,
+                    job.status, time.time() + lease_seconds, job.status, job.id, owner,
+                ),
+            )
+            return cur.rowcount > 0
+
+
+@dataclass
+class BroadcastJob:
+    id: int
+    text: str
+    created_by: int
+    status: str = "running"
+    cursor: int = 0
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    progress_chat_id: Optional[int] = None
+    progress_message_id: Optional[int] = None
+
+    def render(self) -> str:
+        done = self.sent + self.failed + self.blocked
+        return (
+            f"📢 <b>Broadcast #{self.id}</b> — {self.status}\n"
+            f"Progress: {done}/{self.total}\n"
+            f"✅ Sent: {self.sent} | ❌ Failed: {self.failed} | 🚫 Blocked: {self.blocked}"
+        )
+
+
+@dataclass
+class ScheduledJob:
+    name: str
+    interval: float
+    func: Callable[[], Awaitable[Any]]
+    timeout: float
+    jitter: float = 0.1
+    shared: bool = False
+    runs: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    overlaps: int = 0
+    skips: int = 0
+    last_started: Optional[float] = None
+    last_duration: Optional[float] = None
+    last_result: Any = None
+    last_error: Optional[str] = None
+    next_run: Optional[float] = None
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+
+class Scheduler:
+    # Periodic maintenance inside the bot process. A job never overlaps itself: the loop waits
+    # for each run, and a manual /jobs run while one is in flight is skipped. Shared jobs also
+    # go through `claim`, so they run once per interval across all instances, not once each.
+    def __init__(self, claim: Optional[Callable[[str, float], Awaitable[bool]]] = None):
+        self.claim = claim
+        self.jobs: dict[str, ScheduledJob] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def add(
+        self,
+        name: str,
+        interval: float,
+        func: Callable[[], Awaitable[Any]],
+        timeout: Optional[float] = None,
+        jitter: float = 0.1,
+        shared: bool = False,
+    ):
+        # shared: the job touches rows every instance sees; the rest maintain per-process caches.
+        self.jobs[name] = ScheduledJob(name, interval, func, timeout or interval, jitter, shared)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._loop(job)) for job in self.jobs.values()]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _loop(self, job: ScheduledJob):
+        while True:
+            # Jitter keeps instances started together from hitting SQLite in lockstep.
+            delay = job.interval * (1 + random.uniform(-job.jitter, job.jitter))
+            job.next_run = time.time() + delay
+            await asyncio.sleep(delay)
+            await self.run(job)
+
+    async def run(self, job: ScheduledJob, force: bool = False) -> bool:
+        if job.lock.locked():
+            job.overlaps += 1
+            JOB_RUNS.inc(job.name, "overlap")
+            return False
+        async with job.lock:
+            if job.shared and self.claim and not force and not await self._claim(job):
+                job.skips += 1
+                JOB_RUNS.inc(job.name, "skipped")
+                return False
+            job.last_started = time.time()
+            started = time.perf_counter()
+            outcome = "ok"
+            try:
+                job.last_result = await asyncio.wait_for(job.func(), job.timeout)
+                job.last_error = None
+            except asyncio.TimeoutError:
+                outcome = "timeout"
+                job.timeouts += 1
+                job.last_error = f"timed out after {job.timeout:g}s"
+            except Exception as exc:
+                outcome = "error"
+                job.failures += 1
+                job.last_error = f"{type(exc).__name__}: {exc}"
+            finally:
+                job.last_duration = time.perf_counter() - started
+            job.runs += 1
+            JOB_RUNS.inc(job.name, outcome)
+            JOB_SECONDS.observe(job.name, value=job.last_duration)
+            return outcome == "ok"
+
+    async def _claim(self, job: ScheduledJob) -> bool:
+        # Jitter lets a run come up to that much early; the gap still keeps it to one per interval.
+        try:
+            return await self.claim(job.name, job.interval * (1 - job.jitter))
+        except Exception as exc:
+            job.failures += 1
+            job.last_error = f"claim failed: {type(exc).__name__}: {exc}"
+            return False
+
+    def status_lines(self, names: Optional[list[str]] = None) -> list[str]:
+        now = time.time()
+        lines = []
+        for job in self.jobs.values():
+            if names is not None and job.name not in names:
+                continue
+            state = "running" if job.lock.locked() else "idle"
+            last = "never" if job.last_started is None else f"{now - job.last_started:.0f}s ago in {job.last_duration * 1000:.0f}ms"
+            upcoming = "" if job.next_run is None else f", next in {max(0.0, job.next_run - now):.0f}s"
+            lines.append(
+                f"<b>{job.name}</b> every {job.interval:.0f}s ({state}{upcoming})\n"
+                f"    runs={job.runs} failed={job.failures} timeouts={job.timeouts} overlaps={job.overlaps} skipped={job.skips}, last {last}"
+            )
+            if job.last_error:
+                lines.append(f"    ⚠️ {html.escape(job.last_error, quote=False)}")
+            elif job.last_result is not None:
+                lines.append(f"    result: {html.escape(str(job.last_result), quote=False)}")
+        return lines
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        # Flood-wait from Telegram applies to the whole bot, not just one send.
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._updated = self._paused_until
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+DELIVERY_SENT = "sent"
+DELIVERY_FAILED = "failed"
+DELIVERY_BLOCKED = "blocked"
+
+
+async def deliver_message(bot: Bot, chat_id: int, text: str, bucket: TokenBucket, attempts: int = 3) -> str:
+    for attempt in range(attempts):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text)
+            return DELIVERY_SENT
+        except TelegramRetryAfter as exc:
+            bucket.pause(exc.retry_after)
+        except TelegramForbiddenError:
+            return DELIVERY_BLOCKED
+        except TelegramBadRequest as exc:
+            if "chat not found" in exc.message.lower():
+                return DELIVERY_BLOCKED
+            return DELIVERY_FAILED
+        except TelegramNetworkError:
+            await asyncio.sleep(2**attempt)
+        except Exception:
+            return DELIVERY_FAILED
+    return DELIVERY_FAILED
+
+
+class DeliveryQueue:
+    # Fire-and-await notifications: callers get a future per message and can gather the outcomes.
+    def __init__(self, bot: Bot, bucket: TokenBucket, workers: int):
+        self.bot = bot
+        self.bucket = bucket
+        self.workers = workers
+        self._queue: asyncio.Queue[tuple[int, str, asyncio.Future]] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            future.cancel()
+
+    def submit(self, chat_id: int, text: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((chat_id, text, future))
+        return future
+
+    async def _work(self):
+        while True:
+            chat_id, text, future = await self._queue.get()
+            try:
+                outcome = await deliver_message(self.bot, chat_id, text, self.bucket)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            if not future.done():
+                future.set_result(outcome)
+
+
+class BroadcastEngine:
+    # Instances share broadcast_jobs; each job is sent only by the instance holding its lease.
+    def __init__(
+        self,
+        bot: Bot,
+        db: Database,
+        bucket: TokenBucket,
+        concurrency: int,
+        owner: str = INSTANCE_ID,
+        lease_seconds: float = BROADCAST_LEASE_SECONDS,
+    ):
+        self.bot = bot
+        self.db = db
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    async def start(self, text: str, owner_message: Message) -> BroadcastJob:
+        job = await self.db.create_broadcast_job(text, owner_message.from_user.id, self.owner, self.lease_seconds)
+        progress = await owner_message.answer(job.render())
+        job.progress_chat_id, job.progress_message_id = progress.chat.id, progress.message_id
+        await self.db.set_broadcast_progress_message(job.id, progress.chat.id, progress.message_id)
+        self._spawn(job)
+        return job
+
+    async def resume(self) -> int:
+        # Runs on startup and periodically, so jobs of an instance that died or shut down are
+        # picked up once their lease lapses.
+        jobs = await self.db.claim_broadcast_jobs(self.owner, self.lease_seconds)
+        for job in jobs:
+            self._spawn(job)
+        return len(jobs)
+
+    async def stop(self):
+        # Jobs stay 'running' in the table; releasing the lease lets any instance resume them
+        # from their cursor right away.
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.db.release_broadcast_jobs(self.owner)
+
+    def _spawn(self, job: BroadcastJob):
+        if job.id not in self._tasks:
+            self._tasks[job.id] = asyncio.create_task(self._run(job))
+
+    async def _run(self, job: BroadcastJob):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        text = f"📢 Broadcast\n\n{job.text}"
+        last_report = 0.0
+
+        async def send(uid: int) -> str:
+            async with semaphore:
+                return await deliver_message(self.bot, uid, text, self.bucket)
+
+        try:
+            while True:
+                # Small pages bound how many users can be messaged twice after a crash.
+                batch = await self.db.broadcast_recipients(job.cursor, BROADCAST_PAGE_SIZE)
+                if not batch:
+                    break
+                outcomes = await asyncio.gather(*(send(uid) for uid in batch))
+                blocked = [uid for uid, outcome in zip(batch, outcomes) if outcome == DELIVERY_BLOCKED]
+                job.sent += outcomes.count(DELIVERY_SENT)
+                job.failed += outcomes.count(DELIVERY_FAILED)
+                job.blocked += len(blocked)
+                job.cursor = batch[-1]
+                if not await self.db.save_broadcast_progress(job, blocked, self.owner, self.lease_seconds):
+                    return
+                if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    await self._report(job)
+            job.status = "done"
+            if await self.db.save_broadcast_progress(job, [], self.owner, self.lease_seconds):
+                await self._report(job)
+        finally:
+            self._tasks.pop(job.id, None)
+
+    async def _report(self, job: BroadcastJob):
+        if not job.progress_chat_id:
+            return
+        try:
+            await self.bot.edit_message_text(
+                job.render(), chat_id=job.progress_chat_id, message_id=job.progress_message_id
+            )
+        except TelegramAPIError:
+            pass
+
+
+class SQLiteStorage(BaseStorage):
+    # FSM records live in the fsm_storage table; a bounded LRU in front of it also remembers
+    # "no state", because aiogram reads the state on every single update. With cache_ttl set,
+    # entries are only trusted that long, so a state set by another instance shows up here too.
+    def __init__(self, db: Database, ttl: float, cache_size: int, cache_ttl: float = FSM_CACHE_TTL):
+        self.db = db
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        # key -> (state, data, updated_at, cached_at on the monotonic clock)
+        self._cache: OrderedDict[str, tuple[Optional[str], dict[str, Any], float, float]] = OrderedDict()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(
+            str(part if part is not None else "")
+            for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+        )
+
+    async def _load(self, key: str) -> tuple[Optional[str], dict[str, Any]]:
+        record = self._cache.get(key)
+        if record is None or (self.cache_ttl and time.monotonic() - record[3] > self.cache_ttl):
+            row = await self.db.load_fsm_record(key)
+            record = (row[0], json.loads(row[1]), row[2], time.monotonic()) if row else (None, {}, time.time(), time.monotonic())
+            self._remember(key, record)
+        else:
+            self._cache.move_to_end(key)
+        state, data, updated_at, _ = record
+        if (state is not None or data) and updated_at < time.time() - self.ttl:
+            return None, {}
+        return state, data
+
+    def _remember(self, key: str, record: tuple[Optional[str], dict[str, Any], float, float]):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _store(self, key: str, state: Optional[str], data: dict[str, Any]):
+        now = time.time()
+        await self.db.save_fsm_record(key, state, json.dumps(data), now)
+        self._remember(key, (state, data, now, time.monotonic()))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        skey = self._key(key)
+        _, data = await self._load(skey)
+        await self._store(skey, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        skey = self._key(key)
+        state, _ = await self._load(skey)
+        await self._store(skey, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return data.copy()
+
+    async def purge_expired(self):
+        for key in await self.db.purge_fsm_records(time.time() - self.ttl):
+            self._cache.pop(key, None)
+
+    async def close(self) -> None:
+        self._cache.clear()
+
+
+class MediaCache:
+    # Remembers the file_id Telegram hands back for a URL or local file so it is uploaded once.
+    def __init__(self, db: Database):
+        self.db = db
+        self._file_ids: dict[tuple[str, str], Optional[str]] = {}
+        self._digests: dict[str, tuple[int, int, str]] = {}
+
+    async def content_hash(self, source: str) -> str:
+        if not os.path.exists(source):
+            return ""
+        st = os.stat(source)
+        known = self._digests.get(source)
+        if known and known[:2] == (st.st_mtime_ns, st.st_size):
+            return known[2]
+        digest = await asyncio.to_thread(self._hash_file, source)
+        self._digests[source] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 16), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    async def send(self, source: str, kind: str, send) -> Message:
+        digest = await self.content_hash(source)
+        key = (source, digest)
+        if key not in self._file_ids:
+            self._file_ids[key] = await self.db.get_media_file_id(source, digest)
+        file_id = self._file_ids[key]
+        if file_id:
+            try:
+                return await send(file_id)
+            except TelegramBadRequest:
+                # Telegram no longer accepts the id; fall through and upload again.
+                self._file_ids[key] = None
+                await self.db.delete_media_file_id(source, digest)
+
+        sent = await send(FSInputFile(source) if digest else source)
+        file_id = media_file_id(sent, kind)
+        if file_id:
+            self._file_ids = {k: v for k, v in self._file_ids.items() if k[0] != source}
+            self._file_ids[key] = file_id
+            await self.db.save_media_file_id(source, digest, kind, file_id)
+        return sent
+
+
+def media_file_id(message: Message, kind: str) -> Optional[str]:
+    if kind == "photo":
+        return message.photo[-1].file_id if message.photo else None
+    media = getattr(message, kind, None) or message.animation or message.document
+    return media.file_id if media else None
+
+
+class MembershipCache:
+    # LRU of user_id -> (is_member, expires_at). Misses for the same user share one lookup.
+    def __init__(self, positive_ttl: float, negative_ttl: float, max_size: int):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[int, tuple[bool, float]] = OrderedDict()
+        self._inflight: dict[int, asyncio.Future] = {}
+
+    def get(self, user_id: int) -> Optional[bool]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        is_member, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return is_member
+
+    def set(self, user_id: int, is_member: bool):
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    async def lookup(self, user_id: int, fetch, refresh_negative: bool = False) -> bool:
+        cached = self.get(user_id)
+        if cached is not None and (cached or not refresh_negative):
+            self.hits += 1
+            return cached
+        self.misses += 1
+        pending = self._inflight.get(user_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = future
+        try:
+            is_member = await fetch(user_id)
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()
+            raise
+        else:
+            self.set(user_id, is_member)
+            future.set_result(is_member)
+            return is_member
+        finally:
+            self._inflight.pop(user_id, None)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0.0
+        return f"entries={len(self._entries)} hits={self.hits} misses={self.misses} hit_rate={ratio:.1f}%"
+
+
+db = Database(DB_PATH)
+fsm_storage = SQLiteStorage(db, FSM_STATE_TTL, FSM_CACHE_SIZE)
+dp = Dispatcher(storage=fsm_storage)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE)),
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+)
+# Telegram's ~30 msg/s limit is per bot, so every bulk sender draws from one bucket,
+# and cluster workers each get an equal share of it.
+SEND_RATE = TELEGRAM_SEND_RATE / WORKER_COUNT if BOT_MODE == "worker" else TELEGRAM_SEND_RATE
+send_bucket = TokenBucket(SEND_RATE, SEND_RATE)
+broadcasts = BroadcastEngine(bot, db, send_bucket, BROADCAST_CONCURRENCY)
+deliveries = DeliveryQueue(bot, send_bucket, DELIVERY_WORKERS)
+membership = MembershipCache(FORCE_JOIN_CACHE_TTL, FORCE_JOIN_NEGATIVE_TTL, FORCE_JOIN_CACHE_SIZE)
+media = MediaCache(db)
+background_tasks: list[asyncio.Task] = []
+metrics_runners: list[web.AppRunner] = []
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: Update, data: dict[str, Any]) -> Any:
+        kind = event.event_type
+        UPDATES_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_ERRORS.inc(kind)
+            raise
+        finally:
+            UPDATE_SECONDS.observe(kind, value=time.perf_counter() - started)
+            UPDATES_IN_FLIGHT.inc(amount=-1)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data: dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(name, value=time.perf_counter() - started)
+
+
+def parse_throttle_limits(spec: str) -> dict[str, tuple[float, float]]:
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        group, _, limit = item.partition("=")
+        rate, _, burst = limit.partition("/")
+        limits[group.strip()] = (float(rate), float(burst or 1))
+    return limits
+
+
+class UserThrottle:
+    # LRU of (group, user_id) -> (tokens, last refill). An evicted user just starts over with a full bucket.
+    def __init__(self, limits: dict[str, tuple[float, float]], max_size: int):
+        self.limits = limits
+        self.max_size = max_size
+        self.throttled: dict[str, int] = {}
+        self._buckets: OrderedDict[tuple[str, int], tuple[float, float]] = OrderedDict()
+
+    def allow(self, group: str, user_id: int) -> bool:
+        limit = self.limits.get(group, self.limits.get("default"))
+        if limit is None:
+            return True
+        rate, burst = limit
+        now = time.monotonic()
+        key = (group, user_id)
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            self.throttled[group] = self.throttled.get(group, 0) + 1
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+        return allowed
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    # Inner middleware, so it sees the matched handler's flags={"throttle": group}.
+    def __init__(self, throttle: UserThrottle):
+        self.throttle = throttle
+
+    async def __call__(self, handler, event, data: dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is None or is_deposit_reviewer(user.id):
+            return await handler(event, data)
+        group = get_flag(data, "throttle", default="default")
+        if self.throttle.allow(group, user.id):
+            return await handler(event, data)
+        THROTTLED.inc(group)
+        if isinstance(event, CallbackQuery):
+            with suppress(TelegramAPIError):
+                await event.answer("Too many taps, please slow down.")
+        return None
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as exc:
+            API_ERRORS.inc(name, type(exc).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(name, value=time.perf_counter() - started)
 
-    async def add_problem(self, user_id: int, msg: str):
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute("INSERT INTO problems(user_id, message) VALUES (?, ?)", (user_id, msg))
-            await db.commit()
 
-    async def create_deposit_request(self, user_id: int, details: str, screenshot_file_id: str | None, deposit_type: str) -> int:
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(
-                """
-                INSERT INTO deposit_requests(user_id, screenshot_file_id, details, deposit_type)
-                VALUES (?, ?, ?, ?)
-                """,
-                (user_id, screenshot_file_id, details, deposit_type),
-            )
-            await db.commit()
-            return cur.lastrowid
+throttle = UserThrottle(parse_throttle_limits(THROTTLE_LIMITS), THROTTLE_CACHE_SIZE)
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+for observer in (dp.message, dp.callback_query):
+    observer.middleware(ThrottleMiddleware(throttle))
+for observer in (dp.message, dp.callback_query, dp.chat_member):
+    observer.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(ApiMetricsMiddleware())
+metrics.register(Counter("bot_force_join_cache_hits_total", "Force-join membership cache hits.", fn=lambda: membership.hits))
+metrics.register(Counter("bot_force_join_cache_misses_total", "Force-join membership cache misses.", fn=lambda: membership.misses))
+metrics.register(Counter("bot_user_writes_skipped_total", "/start profile writes skipped as unchanged.", fn=lambda: db.seen_users.skipped))
+metrics.register(Gauge("bot_user_writes_pending", "Profile changes waiting for the next flush.", fn=lambda: len(db.seen_users.pending)))
 
-    async def get_deposit_request(self, request_id: int) -> Optional[tuple]:
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(
-                """
-                SELECT id, user_id, screenshot_file_id, details, deposit_type, status
-                FROM deposit_requests
-                WHERE id = ?
-                """,
-                (request_id,),
-            )
-            return await cur.fetchone()
 
-    async def mark_deposit_decision(self, request_id: int, owner_id: int, status: str) -> bool:
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute(
-                """
-                UPDATE deposit_requests
-                SET status = ?, reviewed_by = ?, reviewed_at = CURRENT_TIMESTAMP
-                WHERE id = ? AND status = 'pending'
-                """,
-                (status, owner_id, request_id),
-            )
-            await db.commit()
-            return cur.rowcount > 0
+async def probe_event_loop_lag(interval: float = 0.5):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.set(value=max(0.0, time.perf_counter() - started - interval))
 
-    async def apply_deposit_credit(self, request_id: int, owner_id: int, amount: float) -> Optional[int]:
-        req = await self.get_deposit_request(request_id)
-        if not req:
-            return None
-        _, user_id, _, _, deposit_type, status = req
-        if status == "credited":
-            return -1
 
-        await self.credit_wallet(user_id, deposit_type, amount)
-        async with aiosqlite.connect(self.path) as db:
-            await db.execute(
-                """
-                UPDATE deposit_requests
-                SET status = 'credited', reviewed_by = ?, credited_amount = ?, reviewed_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-                """,
-                (owner_id, amount, request_id),
-            )
-            await db.commit()
-        return user_id
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
 
-    async def solve_problem(self, problem_id: int) -> bool:
-        async with aiosqlite.connect(self.path) as db:
-            cur = await db.execute("UPDATE problems SET status='closed' WHERE id = ?", (problem_id,))
-            await db.commit()
-            return cur.rowcount > 0
 
+async def start_metrics_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    return runner
 
-db = Database(DB_PATH)
-dp = Dispatcher()
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-awaiting_deposit_submission: dict[int, str] = {}
-admin_account_login_state: dict[int, dict] = {}
+
+class DepositStates(StatesGroup):
+    waiting_proof = State()
+
+
+class AccountLoginStates(StatesGroup):
+    waiting_otp = State()
 
 
 def force_join_keyboard() -> InlineKeyboardMarkup:
@@ -436,21 +2792,53 @@ def force_join_keyboard() -> InlineKeyboardMarkup:
     )
 
 
-async def is_force_join_ok(user_id: int) -> bool:
+MEMBER_STATUSES = {"member", "administrator", "creator"}
+
+
+class ForceJoinLookupFailed(Exception):
+    pass
+
+
+async def fetch_force_join_status(user_id: int) -> bool:
+    try:
+        member = await bot.get_chat_member(FORCE_JOIN_CHAT_ID, user_id)
+    except Exception as exc:
+        raise ForceJoinLookupFailed from exc
+    return member.status in MEMBER_STATUSES
+
+
+async def is_force_join_ok(user_id: int, refresh_negative: bool = False) -> bool:
     if not FORCE_JOIN_CHAT_ID:
         return True
     try:
-        member = await bot.get_chat_member(FORCE_JOIN_CHAT_ID, user_id)
-    except Exception:
+        return await membership.lookup(user_id, fetch_force_join_status, refresh_negative)
+    except ForceJoinLookupFailed:
+        # Let users through when Telegram cannot answer, and do not cache that guess.
         return True
-    return member.status in {"member", "administrator", "creator"}
+
+
+def is_force_join_chat(chat) -> bool:
+    if FORCE_JOIN_CHAT_ID.startswith("@"):
+        return (chat.username or "").lower() == FORCE_JOIN_CHAT_ID[1:].lower()
+    return str(chat.id) == FORCE_JOIN_CHAT_ID
+
+
+@dp.chat_member()
+async def force_join_member_update(event: ChatMemberUpdated):
+    if not FORCE_JOIN_CHAT_ID or not is_force_join_chat(event.chat):
+        return
+    membership.set(event.new_chat_member.user.id, event.new_chat_member.status in MEMBER_STATUSES)
 
 
 def is_owner(user_id: int) -> bool:
     return user_id in OWNER_IDS
 
 
-@dp.message(CommandStart())
+def is_deposit_reviewer(user_id: int) -> bool:
+    return user_id == DEPOSIT_REVIEW_OWNER_ID or is_owner(user_id)
+
+
+@dp.message(CommandStart(), flags={"throttle": "start"})
 async def start_cmd(message: Message):
     await db.upsert_user(message)
 
@@ -463,7 +2851,11 @@ async def start_cmd(message: Message):
 
     if WELCOME_VIDEO_URL:
         try:
-            await message.answer_video(video=WELCOME_VIDEO_URL, caption=f"🎬 Welcome to {BRAND_NAME}")
+            await media.send(
+                WELCOME_VIDEO_URL,
+                "video",
+                lambda video: message.answer_video(video=video, caption=f"🎬 Welcome to {BRAND_NAME}"),
+            )
         except Exception:
             pass
 
@@ -475,9 +2867,9 @@ async def start_cmd(message: Message):
     await message.answer(welcome, reply_markup=main_menu())
 
 
-@dp.callback_query(F.data == "check_join")
+@dp.callback_query(F.data == "check_join", flags={"throttle": "start"})
 async def check_join_callback(callback: CallbackQuery):
-    if await is_force_join_ok(callback.from_user.id):
+    if await is_force_join_ok(callback.from_user.id, refresh_negative=True):
         await callback.message.answer("✅ Verification complete.", reply_markup=main_menu())
         await callback.answer("Joined verified")
         return
@@ -489,9 +2881,18 @@ async def back_btn(message: Message):
     await message.answer("Back to main menu.", reply_markup=main_menu())
 
 
+async def country_page_view(account_type: str, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    stock, page, pages = await db.country_page(account_type, page)
+    ids = await db.country_ids([country for country, _, _ in stock])
+    lines = ["Choose country:"]
+    for country, count, min_price in stock:
+        lines.append(f"🌍 {html.escape(country, quote=False)}: ${min_price:.2f} - Stock: {count}")
+    countries = [(ids[country], country) for country, _, _ in stock]
+    return "\n".join(lines), country_keyboard(account_type, countries, page, pages)
+
+
 async def show_account_countries(message: Message, account_type: str, label: str):
-    stock = await db.countries_with_stock(account_type)
-    if not stock:
+    if not db.stock.sorted_countries(account_type):
         await message.answer(f"No {label} stock is available right now.", reply_markup=main_menu())
         return
 
@@ -499,28 +2900,39 @@ async def show_account_countries(message: Message, account_type: str, label: str
         "🟢 <b>Select a Country You Need</b>",
         "⚡ Rate: 1 USDT = ₹89.0",
         "🎁 Tip: Deposit at least ₹1000 today to unlock discount.",
-        "",
     ]
-    countries = []
-    for country, count, min_price in stock:
-        lines.append(f"🌍 {country}: ${min_price:.2f} - Stock: {count}")
-        countries.append(country)
-
     await message.answer("\n".join(lines), reply_markup=back_menu())
-    await message.answer("Choose country:", reply_markup=country_keyboard(account_type, countries))
+    text, keyboard = await country_page_view(account_type, 0)
+    await message.answer(text, reply_markup=keyboard)
 
 
-@dp.message(F.text == BTN_TG1)
+@dp.callback_query(F.data.startswith("cpage:"), flags={"throttle": "browse"})
+async def country_page_turn(callback: CallbackQuery):
+    _, account_type, page = callback.data.split(":", 2)
+    if account_type not in ACCOUNT_TYPES or not page.isdigit():
+        await callback.answer()
+        return
+    if not db.stock.sorted_countries(account_type):
+        await callback.answer("No stock is available right now.", show_alert=True)
+        return
+    text, keyboard = await country_page_view(account_type, int(page))
+    with suppress(TelegramBadRequest):
+        # "message is not modified" when the page did not change.
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
+@dp.message(F.text == BTN_TG1, flags={"throttle": "browse"})
 async def tg1_accounts(message: Message):
     await show_account_countries(message, "tg1", "TG ACCOUNT 1")
 
 
-@dp.message(F.text == BTN_TG2)
+@dp.message(F.text == BTN_TG2, flags={"throttle": "browse"})
 async def tg2_accounts(message: Message):
     await show_account_countries(message, "tg2", "TG ACCOUNT 2")
 
 
-@dp.message(F.text == BTN_WHATSAPP)
+@dp.message(F.text == BTN_WHATSAPP, flags={"throttle": "browse"})
 async def whatsapp_accounts(message: Message):
     await show_account_countries(message, "whatsapp", "WhatsApp accounts")
 
@@ -535,37 +2947,38 @@ async def how_to_use_handler(message: Message):
     await message.answer(f"📖 How to Use: {HOW_TO_USE_LINK}")
 
 
-async def ask_deposit_proof(message: Message, deposit_type: str):
+async def ask_deposit_proof(message: Message, state: FSMContext, deposit_type: str):
     text = f"Please send screenshot + name + UTR for {deposit_type.upper()}."
-    awaiting_deposit_submission[message.from_user.id] = deposit_type
-    if os.path.exists(DEPOSIT_QR_PATH):
-        await message.answer_photo(FSInputFile(DEPOSIT_QR_PATH), caption=text)
+    await state.set_data({"deposit_type": deposit_type})
+    await state.set_state(DepositStates.waiting_proof)
+    if os.path.exists(DEPOSIT_QR_PATH) or DEPOSIT_QR_PATH.startswith(("http://", "https://")):
+        await media.send(DEPOSIT_QR_PATH, "photo", lambda photo: message.answer_photo(photo, caption=text))
     else:
         await message.answer("QR image is not configured yet.\n" + text)
 
 
 @dp.message(F.text == BTN_DEPOSIT1)
-async def deposit1_handler(message: Message):
-    await ask_deposit_proof(message, "deposit_1")
+async def deposit1_handler(message: Message, state: FSMContext):
+    await ask_deposit_proof(message, state, "deposit_1")
 
 
 @dp.message(F.text == BTN_DEPOSIT2)
-async def deposit2_handler(message: Message):
-    await ask_deposit_proof(message, "deposit_2")
+async def deposit2_handler(message: Message, state: FSMContext):
+    await ask_deposit_proof(message, state, "deposit_2")
 
 
-@dp.message(lambda m: m.from_user and m.from_user.id in awaiting_deposit_submission)
-async def capture_deposit_submission(message: Message):
+@dp.message(DepositStates.waiting_proof)
+async def capture_deposit_submission(message: Message, state: FSMContext):
     if message.text == BTN_BACK:
-        awaiting_deposit_submission.pop(message.from_user.id, None)
+        await state.clear()
         await message.answer("Back to main menu.", reply_markup=main_menu())
         return
 
     details = message.caption or message.text or "No details provided"
     screenshot_file_id = message.photo[-1].file_id if message.photo else None
-    deposit_type = awaiting_deposit_submission.get(message.from_user.id, "deposit_1")
+    deposit_type = (await state.get_data()).get("deposit_type", "deposit_1")
     request_id = await db.create_deposit_request(message.from_user.id, details, screenshot_file_id, deposit_type)
-    awaiting_deposit_submission.pop(message.from_user.id, None)
+    await state.clear()
 
     owner_text = (
         "💸 <b>New Deposit Request</b>\n"
@@ -597,7 +3010,7 @@ async def capture_deposit_submission(message: Message):
 
 @dp.callback_query(F.data.startswith("dep_approve:"))
 async def approve_deposit_request(callback: CallbackQuery):
-    if callback.from_user.id != DEPOSIT_REVIEW_OWNER_ID and not is_owner(callback.from_user.id):
+    if not is_deposit_reviewer(callback.from_user.id):
         await callback.answer("Not allowed", show_alert=True)
         return
     request_id = int(callback.data.split(":", 1)[1])
@@ -613,7 +3026,7 @@ async def approve_deposit_request(callback: CallbackQuery):
 
 @dp.callback_query(F.data.startswith("dep_deny:"))
 async def deny_deposit_request(callback: CallbackQuery):
-    if callback.from_user.id != DEPOSIT_REVIEW_OWNER_ID and not is_owner(callback.from_user.id):
+    if not is_deposit_reviewer(callback.from_user.id):
         await callback.answer("Not allowed", show_alert=True)
         return
     request_id = int(callback.data.split(":", 1)[1])
@@ -628,28 +3041,61 @@ async def deny_deposit_request(callback: CallbackQuery):
     await callback.answer("Denied")
 
 
-@dp.message(F.text == BTN_PROFILE)
-async def profile_handler(message: Message):
-    dep1, dep2 = await db.get_wallets(message.from_user.id)
-    history = await db.purchase_history(message.from_user.id)
+def profile_view(page: ProfilePage) -> tuple[str, Optional[InlineKeyboardMarkup]]:
     lines = [
         f"👤 <b>Profile</b>",
-        f"💰 DEPOSIT 1: ₹{dep1:.2f}",
-        f"💰 DEPOSIT 2: ₹{dep2:.2f}",
-        "🧾 Last Purchases:",
+        f"💰 DEPOSIT 1: ₹{page.dep1:.2f}",
+        f"💰 DEPOSIT 2: ₹{page.dep2:.2f}",
+        f"📊 Orders: {page.orders} | Spent: ₹{page.spent:.2f} | Waiting for OTP: {page.pending_otps}",
+        "🧾 Purchases:",
     ]
-    if not history:
+    if not page.purchases:
         lines.append("- No purchases yet.")
     else:
-        for i, (acc_type, number, country, price, status, created_at) in enumerate(history, start=1):
-            lines.append(f"{i}. {acc_type.upper()} | {country} | {number} | ₹{price:.2f} | {status} | {created_at}")
-    await message.answer("\n".join(lines))
+        for purchase_id, acc_type, number, country, price, status, created_at in page.purchases:
+            lines.append(f"#{purchase_id} {acc_type.upper()} | {country} | {number} | ₹{price:.2f} | {status} | {created_at}")
+    nav = []
+    if page.purchases and page.has_newer:
+        nav.append(InlineKeyboardButton(text="⬅️ Newer", callback_data=f"hist:n:{page.purchases[0][0]}"))
+    if page.purchases and page.has_older:
+        nav.append(InlineKeyboardButton(text="Older ➡️", callback_data=f"hist:o:{page.purchases[-1][0]}"))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
 
 
-@dp.callback_query(F.data.startswith("country:"))
+@dp.message(F.text == BTN_PROFILE, flags={"throttle": "browse"})
+async def profile_handler(message: Message):
+    text, keyboard = profile_view(await db.profile(message.from_user.id))
+    await message.answer(text, reply_markup=keyboard)
+
+
+@dp.callback_query(F.data.startswith("hist:"), flags={"throttle": "browse"})
+async def profile_page_turn(callback: CallbackQuery):
+    _, direction, cursor = callback.data.split(":", 2)
+    if direction not in {"o", "n"} or not cursor.isdigit():
+        await callback.answer()
+        return
+    if direction == "o":
+        page = await db.profile(callback.from_user.id, before_id=int(cursor))
+    else:
+        page = await db.profile(callback.from_user.id, after_id=int(cursor))
+    if not page.purchases:
+        page = await db.profile(callback.from_user.id)
+    text, keyboard = profile_view(page)
+    with suppress(TelegramBadRequest):
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
+@dp.callback_query(F.data.startswith("cty:") | F.data.startswith("country:"), flags={"throttle": "reserve"})
 async def country_select(callback):
-    _, account_type, country = callback.data.split(":", 2)
-    account = await db.first_available_for_country(account_type, country)
+    prefix, account_type, country = callback.data.split(":", 2)
+    # Buttons sent before the registry existed carry the name itself ("country:<type>:<name>").
+    if prefix == "cty":
+        country = await db.country_name(int(country)) if country.isdigit() else None
+        if country is None:
+            await callback.answer("This list is out of date, open the menu again.", show_alert=True)
+            return
+    account = await db.reserve_account(callback.from_user.id, account_type, country, ACCOUNT_HOLD_SECONDS)
     if not account:
         await callback.message.answer("No stock available for this country right now.")
         await callback.answer()
@@ -660,6 +3106,7 @@ async def country_select(callback):
         f"🌍 Country: {account.country}\n"
         f"💸 Price: ₹{account.price:.2f}\n"
         f"📦 Available: 1+\n"
+        f"⏳ Reserved for you for {max(1, ACCOUNT_HOLD_SECONDS // 60)} min\n"
         f"✅ Reliable | Affordable | Good Quality\n\n"
         f"⚠️ Important: Please use Telegram X.\n"
         f"🚫 We are not responsible for any freeze/ban."
@@ -668,23 +3115,26 @@ async def country_select(callback):
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("buy:"))
+@dp.callback_query(F.data.startswith("buy:"), flags={"throttle": "buy"})
 async def buy_now(callback):
     account_id = int(callback.data.split(":", 1)[1])
-    account = await db.account_by_id(account_id)
-    if not account or account.status != "available":
+    result = await db.purchase(callback.from_user.id, account_id)
+    if result.status == PURCHASE_HELD:
+        await callback.message.answer("This number is reserved by another buyer. Pick the country again to get yours.")
+        await callback.answer()
+        return
+    if result.status in {PURCHASE_NOT_FOUND, PURCHASE_SOLD}:
         await callback.message.answer("This account is no longer available.")
         await callback.answer()
         return
 
-    purchase_id, wallet_used = await db.purchase(callback.from_user.id, account)
-    if purchase_id is None:
-        dep1, dep2 = await db.get_wallets(callback.from_user.id)
+    account = result.account
+    if result.status == PURCHASE_INSUFFICIENT:
         await callback.message.answer(
             "❌ Insufficient eligible balance.\n"
             f"Price: ₹{account.price:.2f}\n"
-            f"DEPOSIT 1: ₹{dep1:.2f}\n"
-            f"DEPOSIT 2: ₹{dep2:.2f}\n\n"
+            f"DEPOSIT 1: ₹{result.dep1:.2f}\n"
+            f"DEPOSIT 2: ₹{result.dep2:.2f}\n\n"
             "Rules: TG ACCOUNT 2 uses DEPOSUIT 1, TG ACCOUNT 1 uses DEPOSIT 2, WhatsApp uses any."
         )
         await callback.answer()
@@ -695,7 +3145,7 @@ async def buy_now(callback):
         f"Type: {account.account_type.upper()}\n"
         f"Number: <code>{account.number}</code>\n"
         f"Password: <code>{DEFAULT_PASSWORD}</code>\n"
-        f"Wallet Used: <code>{wallet_used}</code>\n\n"
+        f"Wallet Used: <code>{result.wallet_used}</code>\n\n"
         "Waiting for OTP... it will be delivered instantly when received."
     )
     await callback.answer("Purchased")
@@ -714,7 +3164,7 @@ async def report_problem(message: Message):
 
 
 @dp.message(Command("addnumber"))
-async def addnumber_cmd(message: Message):
+async def addnumber_cmd(message: Message, state: FSMContext):
     if not is_owner(message.from_user.id):
         return
     parts = message.text.split()
@@ -737,12 +3187,10 @@ async def addnumber_cmd(message: Message):
         await message.answer("TG ADD ID must be 412 (TG ACCOUNT 1) or 413 (TG ACCOUNT 2).")
         return
 
-    await db.add_account(number, country, price_value, account_type, message.from_user.id)
-    async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute("UPDATE accounts SET tg_add_id = ? WHERE number = ? AND status = 'available'", (tg_id, number))
-        await conn.commit()
+    await db.add_account(number, country, price_value, account_type, message.from_user.id, tg_add_id=tg_id)
 
-    admin_account_login_state[message.from_user.id] = {"number": number, "tg_add_id": tg_id}
+    await state.set_data({"number": number, "tg_add_id": tg_id})
+    await state.set_state(AccountLoginStates.waiting_otp)
     await message.answer(
         f"Added {account_type.upper()} number {number}.\n"
         "Now send OTP from that account in format: /loginotp 1 2 3 4 5\n"
@@ -750,25 +3198,25 @@ async def addnumber_cmd(message: Message):
     )
 
 
-
-
-@dp.message(Command("loginotp"))
-async def loginotp_cmd(message: Message):
+@dp.message(Command("loginotp"), AccountLoginStates.waiting_otp)
+async def loginotp_cmd(message: Message, state: FSMContext):
     if not is_owner(message.from_user.id):
         return
-    state = admin_account_login_state.get(message.from_user.id)
-    if not state:
-        await message.answer("No pending account login. First use /addnumber.")
-        return
     otp = "".join(message.text.split()[1:])
     if len(otp) < 5:
         await message.answer("Usage: /loginotp 1 2 3 4 5")
         return
-    async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute("UPDATE accounts SET login_status = 'logged_in' WHERE number = ?", (state['number'],))
-        await conn.commit()
-    admin_account_login_state.pop(message.from_user.id, None)
-    await message.answer(f"Account {state['number']} login marked complete. OTP setup saved. Use /setotp when OTP arrives. PASS: {DEFAULT_PASSWORD}")
+    number = (await state.get_data())["number"]
+    await db.mark_account_logged_in(number)
+    await state.clear()
+    await message.answer(f"Account {number} login marked complete. OTP setup saved. Use /setotp when OTP arrives. PASS: {DEFAULT_PASSWORD}")
+
+
+@dp.message(Command("loginotp"))
+async def loginotp_without_login(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+    await message.answer("No pending account login. First use /addnumber.")
 
 @dp.message(Command("addaccount"))
 async def addaccount_cmd(message: Message):
@@ -781,7 +3229,7 @@ async def addaccount_cmd(message: Message):
 
     _, account_type, number, country, price = parts[:5]
     account_type = account_type.lower()
-    if account_type not in {"tg1", "tg2", "whatsapp"}:
+    if account_type not in ACCOUNT_TYPES:
         await message.answer("Type must be tg1, tg2 or whatsapp.")
         return
 
@@ -795,6 +3243,125 @@ async def addaccount_cmd(message: Message):
     await message.answer(f"Added {account_type.upper()} account {number} ({country}) ₹{price_value:.2f}.")
 
 
+@dp.message(Command("setprice"))
+async def setprice_cmd(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+    parts = message.text.split()
+    if len(parts) < 4:
+        await message.answer("Usage: /setprice &lt;tg1|tg2|whatsapp&gt; &lt;country&gt; &lt;price&gt;")
+        return
+    account_type = parts[1].lower()
+    country = " ".join(parts[2:-1]).lower()
+    if account_type not in ACCOUNT_TYPES:
+        await message.answer("Type must be tg1, tg2 or whatsapp.")
+        return
+    try:
+        price = float(parts[-1])
+    except ValueError:
+        await message.answer("Invalid price.")
+        return
+    if not 0 < price < float("inf"):
+        await message.answer("Price must be above zero.")
+        return
+    changed = await db.set_price(account_type, country, price)
+    await message.answer(
+        f"Repriced {changed} unsold {account_type.upper()} number(s) in {html.escape(country, quote=False)} to ₹{price:.2f}."
+    )
+
+
+@dataclass
+class StockRow:
+    line: int
+    account_type: str
+    number: str
+    country: str
+    price: float
+    tg_add_id: Optional[int] = None
+
+
+def parse_stock_line(line_no: int, line: str) -> StockRow:
+    fields = next(csv.reader([line])) if "," in line else line.split()
+    fields = [f.strip() for f in fields]
+    if len(fields) not in {4, 5}:
+        raise ValueError("expected type, number, country, price[, tg_add_id]")
+    account_type, number, country, price = fields[0].lower(), fields[1], fields[2].lower(), fields[3]
+    if account_type not in ACCOUNT_TYPES:
+        raise ValueError(f"unknown type {fields[0]!r}")
+    if not number or not country:
+        raise ValueError("number and country are required")
+    try:
+        price_value = float(price)
+    except ValueError:
+        raise ValueError(f"bad price {price!r}") from None
+    if price_value <= 0:
+        raise ValueError("price must be greater than 0")
+    tg_add_id = None
+    if len(fields) == 5 and fields[4]:
+        try:
+            tg_add_id = int(fields[4])
+        except ValueError:
+            raise ValueError(f"bad tg_add_id {fields[4]!r}") from None
+    return StockRow(line_no, account_type, number, country, price_value, tg_add_id)
+
+
+def parse_stock_file(path: str) -> tuple[list[StockRow], list[tuple[int, str]]]:
+    rows: list[StockRow] = []
+    rejected: list[tuple[int, str]] = []
+    seen: set[str] = set()
+    with open(path, encoding="utf-8-sig", errors="replace") as fh:
+        for line_no, line in enumerate(fh, start=1):
+            line = line.strip()
+            if not line or line.startswith("#") or (line_no == 1 and line.lower().startswith("type")):
+                continue
+            try:
+                row = parse_stock_line(line_no, line)
+            except ValueError as exc:
+                rejected.append((line_no, str(exc)))
+                continue
+            if row.number in seen:
+                rejected.append((line_no, f"{row.number} repeated in file"))
+                continue
+            seen.add(row.number)
+            rows.append(row)
+    return rows, rejected
+
+
+@dp.message(Command("importstock"))
+async def importstock_cmd(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if not document:
+        await message.answer(
+            "Send a CSV/TXT file with caption /importstock (or reply /importstock to it).\n"
+            "One account per line: <code>type,number,country,price[,tg_add_id]</code>"
+        )
+        return
+
+    fd, path = tempfile.mkstemp(prefix="importstock_", suffix=".csv")
+    os.close(fd)
+    try:
+        await bot.download(document, destination=path)
+        rows, rejected = await asyncio.to_thread(parse_stock_file, path)
+    finally:
+        os.remove(path)
+    added, duplicates = await db.import_accounts(rows, message.from_user.id) if rows else (0, [])
+    rejected.extend((row.line, f"{row.number} already in stock") for row in duplicates)
+    rejected.sort()
+
+    lines = [
+        "📦 <b>Stock import finished</b>",
+        f"✅ Accepted: {added}",
+        f"❌ Rejected: {len(rejected)}",
+    ]
+    for line_no, reason in rejected[:20]:
+        lines.append(f"Line {line_no}: {html.escape(reason, quote=False)}")
+    if len(rejected) > 20:
+        lines.append(f"... and {len(rejected) - 20} more")
+    await message.answer("\n".join(lines))
+
+
 @dp.message(Command("setbalance"))
 async def setbalance_cmd(message: Message):
     if not is_owner(message.from_user.id):
@@ -804,8 +3371,16 @@ async def setbalance_cmd(message: Message):
         await message.answer("Usage: /setbalance <user_id> <amount>")
         return
     _, user_id, amount = parts
-    await db.credit_wallet(int(user_id), "deposit_1", float(amount))
-    await message.answer("DEPOSIT 1 updated (credit mode).")
+    try:
+        uid, value = int(user_id), float(amount)
+    except ValueError:
+        await message.answer("Invalid user id or amount.")
+        return
+    if value < 0:
+        await message.answer("Amount cannot be negative.")
+        return
+    previous = await db.set_wallet_balance(uid, "deposit_1", value, message.from_user.id)
+    await message.answer(f"DEPOSIT 1 set to ₹{value:.2f} (was ₹{previous:.2f}).")
 
 
 @dp.message(Command("credit"))
@@ -817,13 +3392,20 @@ async def credit_cmd(message: Message):
         await message.answer("Usage: /credit <user_id> <amount>")
         return
     _, user_id, amount = parts
-    await db.credit_wallet(int(user_id), "deposit_2", float(amount))
+    try:
+        uid, value = int(user_id), float(amount)
+    except ValueError:
+        await message.answer("Invalid user id or amount.")
+        return
+    if not await db.credit_wallet(uid, "deposit_2", value, message.from_user.id):
+        await message.answer("DEPOSIT 2 cannot go below zero.")
+        return
     await message.answer("DEPOSIT 2 credited.")
 
 
 @dp.message(Command("add"))
 async def add_deposit_cmd(message: Message):
-    if message.from_user.id != DEPOSIT_REVIEW_OWNER_ID and not is_owner(message.from_user.id):
+    if not is_deposit_reviewer(message.from_user.id):
         return
     parts = message.text.split()
     if len(parts) != 3:
@@ -852,25 +3434,312 @@ async def add_deposit_cmd(message: Message):
     await bot.send_message(user_id, f"✅ Deposit approved and credited: ₹{amt:.2f}\nYour wallet has been updated.")
 
 
+async def pending_deposits_view(status: str, after_id: int) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    rows = await db.deposit_requests_page(status, after_id, DEPOSIT_PAGE_SIZE + 1)
+    more = len(rows) > DEPOSIT_PAGE_SIZE
+    rows = rows[:DEPOSIT_PAGE_SIZE]
+    lines = [f"🧾 <b>Deposit requests: {status}</b>" + (f" (after #{after_id})" if after_id else "")]
+    if not rows:
+        lines.append("- Nothing to review.")
+    for request_id, user_id, deposit_type, details, created_at in rows:
+        summary = " ".join(details.split())
+        if len(summary) > 60:
+            summary = summary[:57] + "..."
+        lines.append(
+            f"<code>{request_id}</code> | user <code>{user_id}</code> | {deposit_type} | {created_at}\n"
+            f"    {html.escape(summary, quote=False)}"
+        )
+    if rows:
+        lines.append("\nCredit several at once: <code>/addmany</code> with one <code>id amount</code> per line.")
+    buttons = []
+    if after_id:
+        buttons.append(InlineKeyboardButton(text="⏮ First", callback_data=f"dpend:{status}:0"))
+    if more:
+        buttons.append(InlineKeyboardButton(text="Next ➡️", callback_data=f"dpend:{status}:{rows[-1][0]}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "\n".join(lines), keyboard
+
+
+@dp.message(Command("pending"))
+async def pending_cmd(message: Message):
+    if not is_deposit_reviewer(message.from_user.id):
+        return
+    parts = message.text.split()
+    status = parts[1].lower() if len(parts) > 1 else "pending"
+    if status not in {"pending", "approved"}:
+        await message.answer("Usage: /pending [pending|approved]")
+        return
+    text, keyboard = await pending_deposits_view(status, 0)
+    await message.answer(text, reply_markup=keyboard)
+
+
+@dp.callback_query(F.data.startswith("dpend:"))
+async def pending_next_page(callback: CallbackQuery):
+    if not is_deposit_reviewer(callback.from_user.id):
+        await callback.answer("Not allowed", show_alert=True)
+        return
+    _, status, after_id = callback.data.split(":", 2)
+    if status not in {"pending", "approved"} or not after_id.isdigit():
+        await callback.answer()
+        return
+    text, keyboard = await pending_deposits_view(status, int(after_id))
+    with suppress(TelegramBadRequest):
+        # "message is not modified" when nothing changed since the page was drawn.
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
+def parse_credit_lines(text: str) -> tuple[dict[int, float], list[str]]:
+    credits: dict[int, float] = {}
+    problems: list[str] = []
+    head, _, rest = text.partition("\n")
+    command_args = head.split(maxsplit=1)[1:]
+    for line in command_args + rest.split("\n"):
+        parts = line.split()
+        if not parts:
+            continue
+        try:
+            if len(parts) != 2:
+                raise ValueError
+            request_id, amount = int(parts[0]), float(parts[1])
+        except ValueError:
+            problems.append(f"⚠️ {html.escape(line.strip())}: expected a deposit id and an amount")
+            continue
+        if amount <= 0:
+            problems.append(f"⚠️ {request_id}: amount must be greater than 0")
+            continue
+        if request_id in credits:
+            problems.append(f"⚠️ {request_id}: listed twice, using the last amount")
+        credits[request_id] = amount
+    return credits, problems
+
+
+@dp.message(Command("addmany"))
+async def addmany_cmd(message: Message):
+    if not is_deposit_reviewer(message.from_user.id):
+        return
+    credits, report = parse_credit_lines(message.text)
+    if not credits:
+        report.insert(0, "Usage: /addmany followed by one <code>deposit_id amount</code> per line.")
+        await answer_lines(message, report)
+        return
+
+    results = await db.apply_deposit_credits(credits, message.from_user.id)
+    pending = {
+        request_id: deliveries.submit(
+            user_id, f"✅ Deposit approved and credited: ₹{credits[request_id]:.2f}\nYour wallet has been updated."
+        )
+        for request_id, (status, user_id) in results.items()
+        if status == DEPOSIT_CREDITED
+    }
+    outcomes = dict(zip(pending, await asyncio.gather(*pending.values())))
+
+    total = 0.0
+    for request_id, (status, user_id) in results.items():
+        if status == DEPOSIT_NOT_FOUND:
+            report.append(f"❌ {request_id}: deposit request not found")
+        elif status == DEPOSIT_ALREADY_CREDITED:
+            report.append(f"⚠️ {request_id}: already credited (user {user_id})")
+        else:
+            total += credits[request_id]
+            note = "" if outcomes[request_id] == DELIVERY_SENT else f", notification {outcomes[request_id]}"
+            report.append(f"✅ {request_id}: ₹{credits[request_id]:.2f} to user {user_id}{note}")
+    credited = len(pending)
+    report.insert(0, f"💸 <b>Bulk credit</b>: {credited}/{len(credits)} credited, ₹{total:.2f} total")
+    await answer_lines(message, report)
+
+
+@dp.message(Command("ledger"))
+async def ledger_cmd(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+    parts = message.text.split()
+    if len(parts) != 2 or not parts[1].isdigit():
+        await message.answer("Usage: /ledger &lt;user_id&gt;")
+        return
+    user_id = int(parts[1])
+    dep1, dep2 = await db.get_wallets(user_id)
+    lines = [
+        f"📒 <b>Ledger for {user_id}</b>",
+        f"DEPOSIT 1: ₹{dep1:.2f} | DEPOSIT 2: ₹{dep2:.2f}",
+    ]
+    entries = await db.ledger_entries(user_id)
+    if not entries:
+        lines.append("- No entries yet.")
+    for entry_id, wallet, kind, amount, balance_after, purchase_id, deposit_id, created_at in entries:
+        link = f" purchase {purchase_id}" if purchase_id else f" deposit {deposit_id}" if deposit_id else ""
+        lines.append(
+            f"#{entry_id} {created_at} {wallet} {kind}{link}: "
+            f"{from_minor(amount):+.2f} → ₹{from_minor(balance_after):.2f}"
+        )
+    await message.answer("\n".join(lines))
+
+
+@dp.message(Command("reconcile"))
+async def reconcile_cmd(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+    scanned, mismatches = await db.reconcile_wallets()
+    lines = [f"🧮 Checked wallets against the last snapshot plus {scanned} newer ledger entries."]
+    if not mismatches:
+        lines.append("✅ All balances match the ledger.")
+    for user_id, wallet, expected, actual in mismatches:
+        lines.append(f"❌ {user_id} {wallet}: ledger ₹{expected:.2f}, balance ₹{actual:.2f}")
+    await answer_lines(message, lines)
+
+
+def parse_otp_lines(text: str) -> tuple[dict[str, str], list[str]]:
+    otps: dict[str, str] = {}
+    problems: list[str] = []
+    head, _, rest = text.partition("\n")
+    command_args = head.split(maxsplit=1)[1:]
+    for line in command_args + rest.split("\n"):
+        parts = line.split()
+        if not parts:
+            continue
+        if len(parts) < 2:
+            problems.append(f"⚠️ {html.escape(line.strip())}: expected a number and an OTP")
+            continue
+        number, otp = parts[0], "".join(parts[1:])
+        if number in otps:
+            problems.append(f"⚠️ {html.escape(number)}: listed twice, using the last OTP")
+        otps[number] = otp
+    return otps, problems
+
+
+async def answer_lines(message: Message, lines: list[str]):
+    chunk: list[str] = []
+    size = 0
+    for line in lines:
+        if chunk and size + len(line) + 1 > 4000:
+            await message.answer("\n".join(chunk))
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    if chunk:
+        await message.answer("\n".join(chunk))
+
+
 @dp.message(Command("setotp"))
 async def setotp_cmd(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+    otps, report = parse_otp_lines(message.text)
+    if not otps:
+        await message.answer(
+            "Usage: /setotp &lt;number&gt; &lt;otp&gt;\nSend several lines of <code>number otp</code> to update many at once."
+        )
+        return
+
+    matched = await db.set_otps(otps)
+    pending = {
+        number: deliveries.submit(
+            user_id,
+            f"🔐 OTP Received\nNumber: <code>{html.escape(number)}</code>\nOTP:- <code>{html.escape(otps[number])}</code>\n"
+            f"PASS :- <code>{DEFAULT_PASSWORD}</code>",
+        )
+        for number, (_, user_id) in matched.items()
+    }
+    outcomes = dict(zip(pending, await asyncio.gather(*pending.values())))
+
+    for number in otps:
+        if number not in matched:
+            report.append(f"❌ {html.escape(number)}: no purchase found")
+        elif outcomes[number] == DELIVERY_SENT:
+            report.append(f"✅ {html.escape(number)}: delivered to {matched[number][1]}")
+        else:
+            report.append(f"⚠️ {html.escape(number)}: saved, delivery {outcomes[number]} (user {matched[number][1]})")
+    delivered = sum(1 for outcome in outcomes.values() if outcome == DELIVERY_SENT)
+    report.insert(0, f"🔐 <b>OTP update</b>: {delivered}/{len(otps)} delivered")
+    await answer_lines(message, report)
+
+
+@dp.message(Command("stats"))
+async def stats_cmd(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+    parts = message.text.split()
+    if len(parts) > 2 or (len(parts) == 2 and not parts[1].isdigit()):
+        await message.answer("Usage: /stats [days]")
+        return
+    days = min(max(int(parts[1]), 1), STATS_MAX_DAYS) if len(parts) == 2 else STATS_DEFAULT_DAYS
+    stats = await db.sales_stats(days)
+    units = sum(row[1] for row in stats.days)
+    revenue = sum(row[2] for row in stats.days)
+    deposit_count = sum(row[3] for row in stats.days)
+    deposits = sum(row[4] for row in stats.days)
+    lines = [
+        f"📊 <b>Sales, last {days} day(s)</b> (UTC)",
+        f"Sold: {units} for ₹{revenue:.2f} | Deposits: {deposit_count} for ₹{deposits:.2f}",
+        "",
+        "<b>By day</b>",
+    ]
+    lines += [
+        f"{day}: {day_units} sold ₹{day_revenue:.2f} | {day_count} dep ₹{day_deposits:.2f}"
+        for day, day_units, day_revenue, day_count, day_deposits in stats.days
+    ] or ["- No activity."]
+    lines += ["", "<b>By type</b>"]
+    lines += [f"{account_type.upper()}: {type_units} sold ₹{type_revenue:.2f}" for account_type, type_units, type_revenue in stats.by_type] or ["- No sales."]
+    lines += ["", "<b>Top countries</b>"]
+    lines += [
+        f"{account_type.upper()} {html.escape(country, quote=False)}: {country_units} sold ₹{country_revenue:.2f}"
+        for account_type, country, country_units, country_revenue in stats.top_countries
+    ] or ["- No sales."]
+    lines += ["", "<b>Stock now</b>"]
+    lines += [f"{account_type.upper()}: {remaining} unsold in {countries} countries" for account_type, remaining, countries in stats.stock] or ["- Out of stock."]
+    await answer_lines(message, lines)
+
+
+export_lock = asyncio.Lock()
+
+
+@dp.message(Command("export"))
+async def export_cmd(message: Message):
     if not is_owner(message.from_user.id):
         return
     parts = message.text.split()
-    if len(parts) < 3:
-        await message.answer("Usage: /setotp <number> <otp>")
-        return
-    _, number, otp = parts[:3]
-    updated = await db.set_otp_and_get_user(number, otp)
-    if not updated:
-        await message.answer("No purchase found for that number.")
-        return
-    _, user_id = updated
-    await bot.send_message(
-        user_id,
-        f"🔐 OTP Received\nNumber: <code>{number}</code>\nOTP:- <code>{otp}</code>\nPASS :- <code>{DEFAULT_PASSWORD}</code>",
+    kind = parts[1].lower() if len(parts) > 1 else ""
+    try:
+        dates = [time.strftime("%Y-%m-%d", time.strptime(part, "%Y-%m-%d")) for part in parts[2:]]
+    except ValueError:
+        dates = None
+    if kind not in Database.EXPORTS or dates is None or len(dates) > 2:
+        await message.answer(f"Usage: /export &lt;{'|'.join(Database.EXPORTS)}&gt; [from YYYY-MM-DD] [to YYYY-MM-DD]")
+        return
+    start, end = (dates + [None, None])[:2]
+    if export_lock.locked():
+        await message.answer("Another export is still running. Try again when it finishes.")
+        return
+    async with export_lock:
+        await message.answer(f"⏳ Exporting {kind}...")
+        fd, path = tempfile.mkstemp(prefix=f"export_{kind}_", suffix=".csv.gz")
+        os.close(fd)
+        try:
+            rows = await db.export_csv(kind, start, end, path)
+            size = os.path.getsize(path)
+            if size > EXPORT_MAX_BYTES:
+                await message.answer(
+                    f"❌ {rows} rows compress to {size / 1024 / 1024:.0f} MB, over Telegram's "
+                    f"{EXPORT_MAX_BYTES // 1024 // 1024} MB limit. Narrow the date range."
+                )
+                return
+            filename = "_".join([kind] + dates) + ".csv.gz"
+            await message.answer_document(FSInputFile(path, filename=filename), caption=f"📤 {kind}: {rows} rows")
+        finally:
+            os.remove(path)
+
+
+@dp.message(Command("cachestats"))
+async def cachestats_cmd(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+    await message.answer(
+        f"Force-join cache: {membership.stats()}\n"
+        f"Seen users: entries={len(db.seen_users)} pending={len(db.seen_users.pending)} "
+        f"unchanged_skipped={db.seen_users.skipped}\n"
+        f"Throttle: buckets={len(throttle)} dropped="
+        + (", ".join(f"{group}={count}" for group, count in sorted(throttle.throttled.items())) or "none")
     )
-    await message.answer("OTP pushed to user instantly.")
 
 
 @dp.message(Command("solve"))
@@ -893,23 +3762,395 @@ async def broadcast_cmd(message: Message):
     if len(parts) < 2:
         await message.answer("Usage: /broadcast <message>")
         return
-    text = parts[1]
-    users = await db.all_users()
-    sent = 0
-    for uid in users:
+    await broadcasts.start(parts[1], message)
+
+
+@dp.message(Command("jobs"))
+async def jobs_cmd(message: Message):
+    if not is_owner(message.from_user.id):
+        return
+    parts = message.text.split()
+    if len(parts) == 3 and parts[1] == "run":
+        job = scheduler.jobs.get(parts[2])
+        if job is None:
+            await message.answer(f"Unknown job. Known: {', '.join(scheduler.jobs)}")
+            return
+        ran = await scheduler.run(job, force=True)
+        if not ran and job.lock.locked():
+            await message.answer(f"{job.name} is already running.")
+            return
+        await answer_lines(message, [f"Ran {job.name}:"] + scheduler.status_lines([job.name]))
+        return
+    await answer_lines(message, ["🗓 <b>Scheduled jobs</b>"] + scheduler.status_lines() + ["", "Run one now: /jobs run &lt;name&gt;"])
+
+
+async def remind_stale_deposits() -> int:
+    count, oldest_id = await db.stale_deposit_requests(DEPOSIT_REMINDER_AFTER)
+    if count:
+        deliveries.submit(
+            DEPOSIT_REVIEW_OWNER_ID,
+            f"⏰ {count} deposit request(s) waiting over {int(DEPOSIT_REMINDER_AFTER // 60)} min, "
+            f"oldest ID <code>{oldest_id}</code>. Review with /pending.",
+        )
+    return count
+
+
+scheduler = Scheduler(claim=db.claim_job_run)
+scheduler.add("release_holds", ACCOUNT_HOLD_SWEEP_INTERVAL, db.release_expired_holds, timeout=10, shared=True)
+scheduler.add("flush_users", USER_FLUSH_INTERVAL, db.flush_users, timeout=10)
+scheduler.add("purge_fsm", FSM_SWEEP_INTERVAL, fsm_storage.purge_expired, timeout=60)
+scheduler.add("sync_stock", STOCK_SYNC_INTERVAL, db.sync_stock, timeout=30)
+scheduler.add("prune_stock_changes", 600, lambda: db.prune_stock_changes(STOCK_CHANGES_KEPT_SECONDS), timeout=60, shared=True)
+scheduler.add("expire_pending_otps", 3600, lambda: db.expire_pending_otps(PENDING_OTP_TTL), timeout=60, shared=True)
+scheduler.add("remind_stale_deposits", DEPOSIT_REMINDER_INTERVAL, remind_stale_deposits, timeout=30, shared=True)
+scheduler.add("snapshot_wallets", WALLET_SNAPSHOT_INTERVAL, db.snapshot_wallets, timeout=300, shared=True)
+scheduler.add("optimize", DB_OPTIMIZE_INTERVAL, db.optimize, timeout=300, shared=True)
+scheduler.add("wal_checkpoint", DB_CHECKPOINT_INTERVAL, db.checkpoint, timeout=60, shared=True)
+scheduler.add("resume_broadcasts", BROADCAST_CLAIM_INTERVAL, broadcasts.resume, timeout=30)
+
+
+@dp.startup()
+async def on_startup(bot: Bot):
+    await db.init()
+    await db.release_expired_holds()
+    await broadcasts.resume()
+    deliveries.start()
+    scheduler.start()
+    background_tasks.append(asyncio.create_task(probe_event_loop_lag()))
+    if METRICS_PORT:
+        metrics_runners.append(await start_metrics_server())
+    if BOT_MODE == "webhook":
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    elif BOT_MODE == "polling":
+        # getUpdates is refused while a webhook is registered.
+        await bot.delete_webhook()
+
+
+@dp.shutdown()
+async def on_shutdown(bot: Bot):
+    if BOT_MODE == "webhook" and WEBHOOK_DELETE_ON_SHUTDOWN:
+        await bot.delete_webhook()
+    await scheduler.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await broadcasts.stop()
+    await deliveries.stop()
+    await fsm_storage.close()
+    for runner in metrics_runners:
+        await runner.cleanup()
+    metrics_runners.clear()
+    await db.close()
+
+
+async def healthz(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+async def run_webhook():
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/healthz", healthz)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+
+def update_user_id(raw: dict[str, Any]) -> Optional[int]:
+    # Same user the dispatcher resolves as event_from_user, read off the raw JSON. Membership
+    # changes go by the member, not the admin who made them: that worker owns their cache entry.
+    for key, event in raw.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if key in ("chat_member", "my_chat_member"):
+            user = (event.get("new_chat_member") or {}).get("user") or user
+        if user:
+            return user["id"]
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+
+class UpdateRouter:
+    # Front half of BOT_MODE=cluster. A user always maps to the same worker and each worker
+    # queue has exactly one forwarder that retries until delivered, so per-user order holds.
+    def __init__(self, urls: list[str], secret: str, batch_size: int = ROUTER_BATCH_SIZE):
+        self.urls = urls
+        self.secret = secret
+        self.batch_size = batch_size
+        self.queues: list[asyncio.Queue] = [asyncio.Queue() for _ in urls]
+        self.routed = [0] * len(urls)
+        self.retries = 0
+        self._session: Optional[ClientSession] = None
+        self._tasks: list[asyncio.Task] = []
+
+    def worker_for(self, user_id: Optional[int]) -> int:
+        # Owners stay on worker 0, which runs broadcasts and /jobs.
+        if user_id is None or is_deposit_reviewer(user_id):
+            return 0
+        return user_id % len(self.urls)
+
+    def route(self, raw: dict[str, Any]) -> int:
+        index = self.worker_for(update_user_id(raw))
+        self.queues[index].put_nowait(raw)
+        self.routed[index] += 1
+        return index
+
+    def queued(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def start(self):
+        self._session = ClientSession(timeout=ClientTimeout(total=60), headers={"X-Worker-Secret": self.secret})
+        self._tasks = [asyncio.create_task(self._forward(index)) for index in range(len(self.urls))]
+
+    async def stop(self, drain_timeout: float = 30.0):
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), drain_timeout)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self._session:
+            await self._session.close()
+
+    async def _forward(self, index: int):
+        queue = self.queues[index]
+        url = self.urls[index] + "/updates"
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            delay = 0.2
+            while True:
+                try:
+                    async with self._session.post(url, json=batch) as resp:
+                        if resp.status == 200:
+                            break
+                except (ClientError, asyncio.TimeoutError):
+                    pass
+                self.retries += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+            for _ in batch:
+                queue.task_done()
+
+
+class UserSerializer:
+    # Worker half: one user's updates run strictly in arrival order, different users run concurrently.
+    def __init__(self):
+        self._tails: dict[int, asyncio.Task] = {}
+        self.processed = 0
+        self.pending = 0
+
+    def submit(self, key: int, make: Callable[[], Awaitable[Any]]):
+        self.pending += 1
+        self._tails[key] = asyncio.create_task(self._run(key, self._tails.get(key), make))
+
+    async def _run(self, key: int, previous: Optional[asyncio.Task], make: Callable[[], Awaitable[Any]]):
         try:
-            await bot.send_message(uid, f"📢 Broadcast\n\n{text}")
-            sent += 1
+            if previous is not None:
+                await asyncio.wait([previous])
+            await make()
         except Exception:
+            # Already counted by UpdateMetricsMiddleware; one bad update must not stall the user.
+            pass
+        finally:
+            self.processed += 1
+            self.pending -= 1
+            if self._tails.get(key) is asyncio.current_task():
+                del self._tails[key]
+
+    async def drain(self):
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+
+worker_updates = UserSerializer()
+metrics.register(Counter("bot_worker_updates_total", "Updates finished by this cluster worker.", fn=lambda: worker_updates.processed))
+metrics.register(Gauge("bot_worker_updates_pending", "Updates accepted by this worker and not finished yet.", fn=lambda: worker_updates.pending))
+
+
+async def worker_updates_endpoint(request: web.Request) -> web.Response:
+    if request.headers.get("X-Worker-Secret") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    for raw in await request.json():
+        key = update_user_id(raw) or 0
+        worker_updates.submit(key, functools.partial(dp.feed_raw_update, bot, raw))
+    return web.Response(text="ok")
+
+
+async def worker_healthz(request: web.Request) -> web.Response:
+    return web.json_response(
+        {"worker": WORKER_INDEX, "processed": worker_updates.processed, "pending": worker_updates.pending}
+    )
+
+
+async def run_worker():
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app.router.add_post("/updates", worker_updates_endpoint)
+    app.router.add_get("/healthz", worker_healthz)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        await web.TCPSite(runner, WORKER_HOST, WORKER_PORT).start()
+        await stop.wait()
+        await worker_updates.drain()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+
+async def spawn_workers(count: int) -> list[asyncio.subprocess.Process]:
+    processes = []
+    for index in range(count):
+        env = {
+            **os.environ,
+            "BOT_MODE": "worker",
+            "WORKER_INDEX": str(index),
+            "WORKER_COUNT": str(count),
+            "WORKER_PORT": str(WORKER_PORT + index),
+            "METRICS_PORT": str(METRICS_PORT + 1 + index if METRICS_PORT else 0),
+        }
+        processes.append(await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env))
+    return processes
+
+
+async def wait_for_workers(session: ClientSession, urls: list[str], timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                async with session.get(url + "/healthz") as resp:
+                    if resp.status == 200:
+                        break
+            except (ClientError, asyncio.TimeoutError):
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Worker {url} did not come up within {timeout:g}s.")
+            await asyncio.sleep(0.2)
+
+
+async def poll_updates(session: ClientSession, router: UpdateRouter):
+    url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/getUpdates"
+    allowed = dp.resolve_used_update_types()
+    offset = 0
+    while True:
+        # Stop confirming updates to Telegram while workers are behind.
+        while router.queued() > ROUTER_MAX_QUEUED:
+            await asyncio.sleep(0.1)
+        try:
+            async with session.post(url, json={"offset": offset, "timeout": 30, "allowed_updates": allowed}) as resp:
+                payload = await resp.json()
+        except (ClientError, asyncio.TimeoutError, ValueError):
+            await asyncio.sleep(1)
             continue
-    await message.answer(f"Broadcast done. Sent to {sent}/{len(users)} users.")
+        if not payload.get("ok"):
+            await asyncio.sleep(payload.get("parameters", {}).get("retry_after", 1))
+            continue
+        for raw in payload["result"]:
+            offset = raw["update_id"] + 1
+            router.route(raw)
+
+
+def front_webhook_handler(router: UpdateRouter):
+    async def handle(request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        router.route(await request.json())
+        return web.Response(text="ok")
+
+    return handle
+
+
+async def run_cluster():
+    urls = WORKER_URLS or [f"http://{WORKER_HOST}:{WORKER_PORT + index}" for index in range(WORKERS)]
+    processes = [] if WORKER_URLS else await spawn_workers(len(urls))
+    router = UpdateRouter(urls, WEBHOOK_SECRET)
+    session = ClientSession(timeout=ClientTimeout(total=60))
+    runner: Optional[web.AppRunner] = None
+    poller: Optional[asyncio.Task] = None
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        await wait_for_workers(session, urls)
+        router.start()
+        if WEBHOOK_BASE_URL:
+            app = web.Application()
+            app.router.add_post(WEBHOOK_PATH, front_webhook_handler(router))
+            app.router.add_get("/healthz", healthz)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            await bot.set_webhook(
+                WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+        else:
+            await bot.delete_webhook()
+            poller = asyncio.create_task(poll_updates(session, router))
+        await stop.wait()
+    finally:
+        if poller:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        if runner:
+            if WEBHOOK_DELETE_ON_SHUTDOWN:
+                with suppress(TelegramAPIError):
+                    await bot.delete_webhook()
+            await runner.cleanup()
+        await router.stop()
+        for process in processes:
+            with suppress(ProcessLookupError):
+                process.terminate()
+        await asyncio.gather(*(process.wait() for process in processes))
+        await session.close()
+        await bot.session.close()
 
 
 async def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is missing. Set it at the top env var or system env.")
-    await db.init()
-    await dp.start_polling(bot)
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_BASE_URL:
+            raise RuntimeError("WEBHOOK_BASE_URL is required when BOT_MODE=webhook.")
+        await run_webhook()
+    elif BOT_MODE == "cluster":
+        await run_cluster()
+    elif BOT_MODE == "worker":
+        await run_worker()
+    else:
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import sys
+from collections import Counter
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import BroadcastEngine, Database, TokenBucket  # noqa: E402
+
+
+class RecordingBot:
+    def __init__(self, sent: Counter, gate: Optional[asyncio.Event] = None):
+        self.sent = sent
+        self.gate = gate
+
+    async def send_message(self, chat_id: int, text: str):
+        if self.gate:
+            await self.gate.wait()
+        await asyncio.sleep(0.001)
+        self.sent[chat_id] += 1
+
+
+async def wait_for_engines(engines: list[BroadcastEngine]):
+    # A task spawned by resume() removes itself from _tasks when the job is done.
+    while any(engine._tasks for engine in engines):
+        await asyncio.gather(*(task for engine in engines for task in list(engine._tasks.values())))
+
+
+def test_two_instances_resume_a_running_broadcast_once(tmp_path):
+    path = str(tmp_path / "bot.db")
+    users = list(range(1, 451))
+
+    async def scenario():
+        first, second = Database(path), Database(path)
+        await first.init()
+        await second.init()
+        sent: Counter = Counter()
+        engines = [
+            BroadcastEngine(RecordingBot(sent), db, TokenBucket(100000, 100000), 20, owner=owner)
+            for db, owner in ((first, "host-a:1"), (second, "host-b:1"))
+        ]
+        try:
+            async with first.write() as conn:
+                await conn.executemany("INSERT INTO users(user_id) VALUES (?)", [(uid,) for uid in users])
+                # Left 'running' by an instance that crashed before its lease was written.
+                await conn.execute("INSERT INTO broadcast_jobs(text, created_by, total) VALUES ('hi', 1, ?)", (len(users),))
+
+            claimed = await asyncio.gather(*(engine.resume() for engine in engines))
+            assert sorted(claimed) == [0, 1]
+            await wait_for_engines(engines)
+            # The lease is gone once the job is done, but a finished job is never claimed again.
+            assert await asyncio.gather(*(engine.resume() for engine in engines)) == [0, 0]
+
+            async with first.read() as conn:
+                cur = await conn.execute("SELECT status, sent, lease_until FROM broadcast_jobs")
+                assert await cur.fetchall() == [("done", len(users), None)]
+        finally:
+            await first.close()
+            await second.close()
+        return sent
+
+    sent = asyncio.run(asyncio.wait_for(scenario(), 60))
+    assert sorted(sent) == users
+    assert set(sent.values()) == {1}
+
+
+def test_broadcast_stops_when_another_instance_holds_the_lease(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def scenario():
+        db = Database(path)
+        await db.init()
+        sent: Counter = Counter()
+        gate = asyncio.Event()
+        engine = BroadcastEngine(RecordingBot(sent, gate), db, TokenBucket(100000, 100000), 20, owner="host-a:1")
+        try:
+            async with db.write() as conn:
+                await conn.executemany("INSERT INTO users(user_id) VALUES (?)", [(uid,) for uid in range(1, 301)])
+                await conn.execute("INSERT INTO broadcast_jobs(text, created_by, total) VALUES ('hi', 1, 300)")
+            assert await engine.resume() == 1
+            # Another instance took the job over, as after this one stalled past its lease.
+            async with db.write() as conn:
+                await conn.execute("UPDATE broadcast_jobs SET owner = 'host-b:1'")
+            gate.set()
+            await wait_for_engines([engine])
+            async with db.read() as conn:
+                cur = await conn.execute("SELECT status, owner FROM broadcast_jobs")
+                assert await cur.fetchall() == [("running", "host-b:1")]
+        finally:
+            await db.close()
+        return sent
+
+    sent = asyncio.run(asyncio.wait_for(scenario(), 60))
+    # Only the page that was in flight when the lease moved.
+    assert sorted(sent) == list(range(1, 101))
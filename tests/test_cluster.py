@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import update_user_id  # noqa: E402
+
+
+def test_membership_updates_route_by_affected_user():
+    chat = {"id": -100123, "type": "supergroup", "title": "Channel"}
+    admin = {"id": 7, "is_bot": False, "first_name": "Admin"}
+    member = {"id": 42, "is_bot": False, "first_name": "Member"}
+    change = {
+        "chat": chat,
+        "from": admin,
+        "date": 0,
+        "old_chat_member": {"status": "member", "user": member},
+        "new_chat_member": {"status": "kicked", "user": member, "until_date": 0},
+    }
+    assert update_user_id({"update_id": 1, "chat_member": change}) == 42
+    assert update_user_id({"update_id": 2, "my_chat_member": change}) == 42
+    assert update_user_id({"update_id": 3, "message": {"message_id": 1, "date": 0, "chat": chat, "from": admin}}) == 7
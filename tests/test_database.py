@@ -0,0 +1,198 @@
+import asyncio
+import csv
+import gzip
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import Database, Scheduler  # noqa: E402
+
+
+def test_cancelled_begin_leaves_writer_usable(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def scenario():
+        db = Database(path)
+        await db.init()
+        # Another process holds the write lock, so BEGIN IMMEDIATE waits on busy_timeout.
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+
+        async def writer():
+            async with db.write() as conn:
+                await conn.execute("INSERT INTO users(user_id) VALUES (1)")
+
+        task = asyncio.create_task(writer())
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await asyncio.sleep(0.1)
+        other.execute("COMMIT")
+        other.close()
+        await asyncio.gather(task, return_exceptions=True)
+
+        async with db.write() as conn:
+            await conn.execute("INSERT INTO users(user_id) VALUES (2)")
+        assert not db._writer.in_transaction
+        async with db.read() as conn:
+            cur = await conn.execute("SELECT user_id FROM users ORDER BY user_id")
+            assert [row[0] for row in await cur.fetchall()] == [2]
+        await asyncio.wait_for(db.close(), 10)
+
+    asyncio.run(asyncio.wait_for(scenario(), 30))
+
+
+def test_checkpoint_does_not_stall_writes_behind_a_long_reader(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def scenario():
+        db = Database(path)
+        await db.init()
+        try:
+            async with db.write() as conn:
+                await conn.execute("INSERT INTO users(user_id) VALUES (1)")
+            # A long export keeps a read snapshot open while new frames land in the WAL.
+            reader = sqlite3.connect(path, isolation_level=None)
+            reader.execute("BEGIN")
+            reader.execute("SELECT COUNT(*) FROM users").fetchone()
+            async with db.write() as conn:
+                await conn.execute("INSERT INTO users(user_id) VALUES (2)")
+
+            checkpoint = asyncio.create_task(db.checkpoint())
+            async with db.write() as conn:
+                await asyncio.wait_for(conn.execute("INSERT INTO users(user_id) VALUES (3)"), 2)
+            assert (await asyncio.wait_for(checkpoint, 2)).startswith("partial:")
+
+            reader.execute("COMMIT")
+            reader.close()
+            assert not (await db.checkpoint()).startswith("partial:")
+        finally:
+            await db.close()
+
+    asyncio.run(asyncio.wait_for(scenario(), 30))
+
+
+def test_fsm_state_set_by_another_instance_is_seen(tmp_path):
+    from aiogram.fsm.storage.base import StorageKey
+
+    from bot import SQLiteStorage
+
+    path = str(tmp_path / "bot.db")
+    key = StorageKey(bot_id=1, chat_id=5, user_id=5)
+
+    async def scenario():
+        first, second = Database(path), Database(path)
+        await first.init()
+        await second.init()
+        storage_a = SQLiteStorage(first, ttl=3600, cache_size=100, cache_ttl=0.2)
+        storage_b = SQLiteStorage(second, ttl=3600, cache_size=100, cache_ttl=0.2)
+        try:
+            # A caches "no state", then B sets one.
+            assert await storage_a.get_state(key) is None
+            await storage_b.set_state(key, "DepositStates:waiting_proof")
+            await storage_b.set_data(key, {"wallet": "deposit_1"})
+            await asyncio.sleep(0.3)
+            assert await storage_a.get_state(key) == "DepositStates:waiting_proof"
+            assert await storage_a.get_data(key) == {"wallet": "deposit_1"}
+            # And back: A clears it, B stops seeing it.
+            await storage_a.set_state(key, None)
+            await asyncio.sleep(0.3)
+            assert await storage_b.get_state(key) is None
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(asyncio.wait_for(scenario(), 30))
+
+
+def test_export_keeps_user_text_out_of_spreadsheet_formulas(tmp_path):
+    path = str(tmp_path / "bot.db")
+    out = str(tmp_path / "users.csv.gz")
+
+    async def scenario():
+        db = Database(path)
+        await db.init()
+        try:
+            async with db.write() as conn:
+                await conn.execute(
+                    "INSERT INTO users(user_id, username, first_name) VALUES (1, '@admin', '=HYPERLINK(\"http://x\")')"
+                )
+                await conn.execute("INSERT INTO users(user_id, username, first_name) VALUES (2, 'plain', 'Asha')")
+            return await db.export_csv("users", None, None, out)
+        finally:
+            await db.close()
+
+    assert asyncio.run(asyncio.wait_for(scenario(), 30)) == 2
+    with gzip.open(out, "rt", encoding="utf-8", newline="") as fh:
+        rows = {row["user_id"]: row for row in csv.DictReader(fh)}
+    assert rows["1"]["username"] == "'@admin"
+    assert rows["1"]["first_name"] == "'=HYPERLINK(\"http://x\")"
+    assert rows["2"]["username"] == "plain" and rows["2"]["first_name"] == "Asha"
+
+
+def test_shared_jobs_run_once_per_interval_across_instances(tmp_path):
+    path = str(tmp_path / "bot.db")
+    runs = {"shared": 0, "local": 0}
+
+    async def shared():
+        runs["shared"] += 1
+
+    async def local():
+        runs["local"] += 1
+
+    async def scenario():
+        first, second = Database(path), Database(path)
+        await first.init()
+        await second.init()
+        try:
+            schedulers = [Scheduler(claim=first.claim_job_run), Scheduler(claim=second.claim_job_run)]
+            for scheduler in schedulers:
+                scheduler.add("remind", 0.5, shared, jitter=0, shared=True)
+                scheduler.add("cache", 0.5, local, jitter=0)
+            for scheduler in schedulers:
+                assert await scheduler.run(scheduler.jobs["cache"])
+            ran = [await scheduler.run(scheduler.jobs["remind"]) for scheduler in schedulers]
+            assert ran == [True, False] and schedulers[1].jobs["remind"].skips == 1
+            # An owner's /jobs run is not held back by the other instance's claim.
+            assert await schedulers[1].run(schedulers[1].jobs["remind"], force=True)
+            await asyncio.sleep(0.6)
+            ran = [await scheduler.run(scheduler.jobs["remind"]) for scheduler in reversed(schedulers)]
+            assert ran == [True, False]
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert runs == {"shared": 3, "local": 2}
+
+
+def test_fsm_reads_are_served_from_cache_by_default(tmp_path):
+    from aiogram.fsm.storage.base import StorageKey
+
+    from bot import SQLiteStorage
+
+    path = str(tmp_path / "bot.db")
+    key = StorageKey(bot_id=1, chat_id=5, user_id=5)
+
+    async def scenario():
+        db = Database(path)
+        await db.init()
+        storage = SQLiteStorage(db, ttl=3600, cache_size=100)
+        statements: list[str] = []
+        try:
+            await storage.set_state(key, "DepositStates:waiting_proof")
+            for conn in (db._writer, *db._all_readers):
+                await conn.set_trace_callback(statements.append)
+            assert await storage.get_state(key) == "DepositStates:waiting_proof"
+            await asyncio.sleep(2.1)
+            assert await storage.get_state(key) == "DepositStates:waiting_proof"
+            assert await storage.get_data(key) == {}
+            for conn in (db._writer, *db._all_readers):
+                await conn.set_trace_callback(None)
+        finally:
+            await db.close()
+        return statements
+
+    statements = asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert not [sql for sql in statements if "SELECT" in sql.upper()]